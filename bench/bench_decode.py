@@ -0,0 +1,52 @@
+# Стоимость разбора одного обновления вебхука.
+#
+# База не нужна. Для каждого файла из --payloads (тела запросов Telegram, по одному
+# обновлению в файле) сравнивает прежний путь (json.loads, затем types.Update) и
+# UpdateDecoder.decode. Обновления типов, которые бот не обрабатывает, новым путем
+# отбрасываются без создания объектов aiogram.
+#
+#   python bench/bench_decode.py --iterations 20000
+import argparse
+import glob
+import json
+import os
+import time
+
+import common
+import bot
+from aiogram import types
+
+
+def legacy_decode(body: bytes):
+    return types.Update(**json.loads(body))
+
+
+def measure(decode, body: bytes, iterations: int):
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        decode(body)
+        durations.append(time.perf_counter() - started)
+    return common.summarize(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--payloads', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads'))
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"json_loads: {bot.json_loads.__module__}", flush=True)
+    for path in sorted(glob.glob(os.path.join(args.payloads, '*.json'))):
+        with open(path, 'rb') as f:
+            body = f.read()
+        result = {
+            "bytes": len(body),
+            "legacy": measure(legacy_decode, body, args.iterations),
+            "decoder": measure(bot.update_decoder.decode, body, args.iterations),
+        }
+        print(f"{os.path.basename(path)}: {json.dumps(result)}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Задержка check_eligibility в зависимости от размера used_codes.
+#
+# Заполняет used_codes до каждого размера из --sizes и измеряет проверку для случайных
+# выданных и новых пользователей. С индексами по user_id и ip_address задержка должна
+# оставаться примерно постоянной при росте таблицы до миллионов строк.
+#
+#   python bench/bench_eligibility.py --sizes 10000,100000,1000000
+import argparse
+import asyncio
+import json
+import random
+
+import common  # noqa: F401  (переменные окружения для bot.py)
+import bot
+
+
+async def fill_used_codes(size: int):
+    async with bot.get_db_connection() as conn:
+        current = await conn.fetchval("SELECT count(*) FROM used_codes")
+        if current < size:
+            await conn.execute('''
+                INSERT INTO used_codes (user_id, code, ip_address)
+                SELECT n, 'BENCH' || n, n::text FROM generate_series($1::bigint, $2::bigint) AS n
+            ''', current + 1, size)
+        await conn.execute("ANALYZE used_codes")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    await bot.create_tables()  # До пула: соединения пула подготавливают запросы к этим таблицам
+    await bot.create_db_pool()
+    async with bot.get_db_connection() as conn:
+        await conn.execute("TRUNCATE used_codes")
+
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        await fill_used_codes(size)
+        # Половина проверок для выданных пользователей, половина — для новых
+        user_ids = [random.randint(1, size) if i % 2 else size + random.randint(1, size) for i in range(args.iterations)]
+        durations = await common.timed(lambda i: bot.check_eligibility(user_ids[i], str(user_ids[i])), args.iterations)
+        results[size] = common.summarize(durations)
+        print(f"used_codes={size}: {json.dumps(results[size])}", flush=True)
+
+    await bot.close_db_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
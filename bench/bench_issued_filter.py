@@ -0,0 +1,65 @@
+# Память и скорость фильтра выданных кодов (IssuedIdSet и IssuedBloomFilter).
+#
+# База не нужна. Заполняет фильтр --count случайными id (как при загрузке из used_codes
+# и как при выдаче кодов по одному) и измеряет проверку для известных и новых id.
+#
+#   python bench/bench_issued_filter.py --count 1000000
+import argparse
+import json
+import random
+import time
+
+import common
+import bot
+
+
+def measure(name, factory, ids, lookups, sorted_load: bool):
+    target = factory()
+    started = time.perf_counter()
+    if sorted_load:
+        target.extend_sorted(sorted(ids))
+    else:
+        for value in ids:
+            target.add(value)
+    load_seconds = time.perf_counter() - started
+
+    durations = []
+    for value in lookups:
+        started = time.perf_counter()
+        value in target
+        durations.append(time.perf_counter() - started)
+    false_positives = sum(value in target for value in lookups[len(lookups) // 2:])
+
+    result = {
+        "load_s": round(load_seconds, 3),
+        "memory_mb_per_million": round(target.memory_bytes() / len(ids) * 1_000_000 / 2 ** 20, 2),
+        "false_positive_rate": round(false_positives / (len(lookups) - len(lookups) // 2), 5),
+        "lookup": common.summarize(durations),
+    }
+    print(f"{name}: {json.dumps(result)}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=1_000_000)
+    parser.add_argument('--lookups', type=int, default=100_000)
+    parser.add_argument('--fp-rate', type=float, default=bot.ISSUED_FILTER_FP_RATE)
+    args = parser.parse_args()
+
+    ids = random.sample(range(1, 8_000_000_000), args.count)
+    # Первая половина проверок — известные id, вторая — новые
+    known = random.sample(ids, args.lookups // 2)
+    unknown = [8_000_000_000 + random.randint(1, 10 ** 9) for _ in range(args.lookups - len(known))]
+    lookups = known + unknown
+
+    measure("exact (startup load)", bot.IssuedIdSet, ids, lookups, sorted_load=True)
+    measure("exact (one by one)", bot.IssuedIdSet, ids, lookups, sorted_load=False)
+    measure(
+        f"bloom fp={args.fp_rate}",
+        lambda: bot.IssuedBloomFilter(args.count, args.fp_rate),
+        ids, lookups, sorted_load=False,
+    )
+
+
+if __name__ == '__main__':
+    main()
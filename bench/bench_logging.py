@@ -0,0 +1,89 @@
+# Стоимость логирования одного обновления get_code в потоке цикла событий.
+#
+# База не нужна. Режимы:
+#   legacy — как раньше: basicConfig(DEBUG), f-строки, две строки LoggingMiddleware
+#            на каждое обновление, запись в поток вывода прямо из вызывающего потока;
+#   queue  — QueueHandler + QueueListener, JSON, LOG_LEVEL=INFO: отладочные строки
+#            отключены и ничего не стоят;
+#   queue_debug — то же с LOG_LEVEL=DEBUG и выборкой 1 из --sample-every строк.
+# Вывод идет в os.devnull. drain_ms — сколько фоновый поток дописывал очередь после
+# последнего обновления.
+#
+#   python bench/bench_logging.py --updates 100000
+import argparse
+import json
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueListener
+
+import common
+import bot
+
+logger = logging.getLogger('bench')
+
+
+def configure(mode: str):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    if mode == 'legacy':
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        return None
+    handler.setFormatter(bot.JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    root.addHandler(bot.LogQueueHandler(log_queue))
+    root.setLevel(logging.DEBUG if mode == 'queue_debug' else logging.INFO)
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+def legacy_update(i: int):
+    logger.info(f"Received callback query [ID:{i}] from user [ID:{i}] for message [ID:{i}] with data: get_code")
+    logger.debug(f"User {i} clicked on 'get_code'. IP: {i}")
+    logger.debug(f"User {i} status in channel: member")
+    logger.info(f"Handled callback query [ID:{i}] from user [ID:{i}] for message [ID:{i}] with data: get_code")
+
+
+def sampled_update(update_log):
+    def log_update(i: int):
+        update_log.debug("Обработка обновления %s, ожидание в очереди %.1f мс", i, 0.5)
+        update_log.debug("User %s clicked on 'get_code'. IP: %s", i, i)
+        update_log.debug("User %s status in channel: %s", i, 'member')
+    return log_update
+
+
+def run(mode: str, updates: int, sample_every: int):
+    listener = configure(mode)
+    log_update = legacy_update if mode == 'legacy' else sampled_update(bot.SampledLogger(logger, 1 / sample_every))
+    durations = []
+    for i in range(updates):
+        started = time.perf_counter()
+        log_update(i)
+        durations.append(time.perf_counter() - started)
+    result = common.summarize(durations)
+    if listener is not None:
+        started = time.perf_counter()
+        listener.stop()
+        result["drain_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=100000)
+    parser.add_argument('--sample-every', type=int, default=100)
+    args = parser.parse_args()
+
+    for mode in ('legacy', 'queue', 'queue_debug'):
+        result = run(mode, args.updates, args.sample_every)
+        print(f"{mode}: {json.dumps(result)}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Задержка горячих запросов в зависимости от режима подготовки запросов.
+#
+# Режимы:
+#   pgbouncer  — DB_PGBOUNCER=1: кеш запросов отключен, каждый запрос разбирается заново;
+#   lazy_cache — кеш asyncpg без реестра: запрос подготавливается при первом вызове
+#                на каждом соединении (поведение до реестра запросов);
+#   registry   — горячие запросы подготовлены при создании соединения пула.
+#
+# Для каждого режима измеряется первый запрос на каждом новом соединении (first_call)
+# и установившаяся задержка (steady).
+#
+#   python bench/bench_statements.py --connections 10 --iterations 2000
+import argparse
+import asyncio
+import json
+import time
+
+import common  # noqa: F401  (переменные окружения для bot.py)
+import bot
+
+MODES = {
+    'pgbouncer': (True, False),
+    'lazy_cache': (False, False),
+    'registry': (False, True),
+}
+
+
+async def first_calls(connections: int):
+    # Держим все соединения занятыми, чтобы первый запрос пришелся на каждое из них
+    durations = []
+    held = [await bot.db_pool.acquire() for _ in range(connections)]
+    try:
+        for i, conn in enumerate(held):
+            started = time.perf_counter()
+            await bot.statements.fetchrow(conn, 'check_eligibility', i, str(i))
+            durations.append(time.perf_counter() - started)
+    finally:
+        for conn in held:
+            await bot.db_pool.release(conn)
+    return durations
+
+
+async def run_mode(name: str, connections: int, iterations: int):
+    bot.DB_PGBOUNCER, bot.statements.cache_enabled = MODES[name]
+    bot.DB_POOL_MIN_SIZE = bot.DB_POOL_MAX_SIZE = connections
+    await bot.create_db_pool()
+    try:
+        first = await first_calls(connections)
+        steady = await common.timed(lambda i: bot.check_eligibility(i, str(i)), iterations)
+    finally:
+        await bot.close_db_pool()
+    return {"first_call": common.summarize(first), "steady": common.summarize(steady)}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--modes', default=','.join(MODES))
+    args = parser.parse_args()
+
+    await bot.create_tables()
+    for name in args.modes.split(','):
+        result = await run_mode(name, args.connections, args.iterations)
+        print(f"{name}: {json.dumps(result)}", flush=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+# Общие настройки для офлайн-бенчмарков.
+#
+# Бенчмарки импортируют bot.py, поэтому ему нужны переменные окружения. Значения ниже
+# используются, только если переменная не задана. База берется из DB_* — запускайте
+# бенчмарки на отдельной базе: они очищают таблицы codes и used_codes.
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+BENCH_ENV = {
+    'API_TOKEN': '123456:bench-token',
+    'ADMIN_IDS': '1',
+    'CHANNEL_ID': '-1000000000001',
+    'DB_USER': 'postgres',
+    'DB_PASSWORD': 'postgres',
+    'DB_NAME': 'bonuscodes_bench',
+    'WEBHOOK_URL': 'http://127.0.0.1:10000',
+    # Запросы к Bot API идут в локальную заглушку bench/fake_bot_api.py
+    'BOT_API_URL': 'http://127.0.0.1:8081',
+}
+for key, value in BENCH_ENV.items():
+    os.environ.setdefault(key, value)
+
+
+# Перцентили в миллисекундах по списку длительностей в секундах
+def summarize(durations):
+    durations = sorted(durations)
+    if not durations:
+        return {"count": 0}
+
+    def percentile(p):
+        return durations[min(len(durations) - 1, int(len(durations) * p))] * 1000
+
+    return {
+        "count": len(durations),
+        "mean_ms": round(statistics.fmean(durations) * 1000, 4),
+        "p50_ms": round(percentile(0.50), 4),
+        "p95_ms": round(percentile(0.95), 4),
+        "p99_ms": round(percentile(0.99), 4),
+        "max_ms": round(durations[-1] * 1000, 4),
+    }
+
+
+async def timed(coro_factory, iterations: int):
+    durations = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        await coro_factory(i)
+        durations.append(time.perf_counter() - started)
+    return durations
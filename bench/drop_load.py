@@ -0,0 +1,349 @@
+# Нагрузочный тест раздачи кодов через /webhook.
+#
+# Поднимает заглушку Bot API (bench/fake_bot_api.py) в этом процессе и бота отдельным
+# процессом (python bot.py, порт 10000), заполняет codes на --inventory кодов и шлет
+# синтетические обновления: /start и нажатие get_code от --users пользователей со
+# скоростью --rate обновлений в секунду. Часть пользователей не подписана на канал
+# (--non-subscribers), часть жмет кнопку несколько раз (--repeat-fraction, --repeat-taps).
+#
+# Отказ вебхука (например, 503 при переполненной очереди) не теряет обновление: как и
+# Telegram, скрипт повторяет доставку с экспоненциальной паузой (--max-redeliveries,
+# --redelivery-delay).
+#
+# Отчет: пропускная способность, задержка ответа вебхука и время до итогового ответа
+# пользователю (p50/p95/p99), число повторных доставок, выдано кодов против ожидаемого и
+# число повторно выданных кодов. С --output отчет сохраняется как базовая линия, с
+# --baseline сравнивается с сохраненной. Скрипт завершается с ошибкой при повторной выдаче
+# кодов, если выдано не столько кодов, сколько ожидалось, если кто-то из пользователей
+# остался без ответа, если обновление так и не доставлено или при регрессии больше --tolerance.
+#
+# База очищается (codes, used_codes, channel_members, processed_updates) — запускайте
+# на отдельной базе.
+#
+#   python bench/drop_load.py --users 500 --inventory 100 --rate 500 --output bench/baselines/drop_500_users.json
+#   python bench/drop_load.py --users 500 --inventory 100 --rate 500 --baseline bench/baselines/drop_500_users.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+import asyncpg
+
+import common
+import bot
+import fake_bot_api
+
+BOT_URL = 'http://127.0.0.1:10000'
+BOT_LOG = os.path.join(tempfile.gettempdir(), 'drop_load_bot.log')  # stderr процесса бота
+USER_ID_BASE = 10_000_000
+CODE_PATTERN = re.compile(r"Ваш уникальный код: (\S+)")
+PROGRESS_PREFIX = '⏳'
+
+
+def make_user(user_id: int):
+    return {"id": user_id, "is_bot": False, "first_name": "Load", "language_code": "ru"}
+
+
+def start_update(update_id: int, user_id: int):
+    return {"update_id": update_id, "message": {
+        "message_id": 1, "from": make_user(user_id), "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"}, "text": "/start",
+        "entities": [{"offset": 0, "length": 6, "type": "bot_command"}],
+    }}
+
+
+def get_code_update(update_id: int, user_id: int, tap: int):
+    return {"update_id": update_id, "callback_query": {
+        "id": f"{user_id}-{tap}", "from": make_user(user_id), "chat_instance": str(user_id), "data": "get_code",
+        "message": {
+            "message_id": 2, "from": fake_bot_api.BOT_USER, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "text": "Нажмите на кнопку ниже",
+        },
+    }}
+
+
+# Сценарий: у каждого пользователя /start, затем одно или несколько нажатий get_code.
+# Пользователи идут по порядку, нажатия одного пользователя — подряд.
+def build_traffic(args):
+    users = [USER_ID_BASE + i for i in range(args.users)]
+    repeaters = set(users[::max(1, round(1 / args.repeat_fraction))] if args.repeat_fraction > 0 else [])
+    traffic = []
+    update_id = 1
+    for user_id in users:
+        traffic.append((start_update(update_id, user_id), user_id, 'start'))
+        update_id += 1
+        for tap in range(args.repeat_taps if user_id in repeaters else 1):
+            traffic.append((get_code_update(update_id, user_id, tap), user_id, 'get_code'))
+            update_id += 1
+    return traffic, repeaters
+
+
+async def prepare_database(inventory: int):
+    await bot.create_tables()
+    conn = await asyncpg.connect(**bot.DB_CONNECT_KWARGS)
+    try:
+        await conn.execute("TRUNCATE codes, used_codes, channel_members")
+        await conn.execute("DROP TABLE IF EXISTS processed_updates")
+        await conn.copy_records_to_table(
+            'codes', records=[(f"DROP{i:07d}", "https://example.com") for i in range(inventory)],
+            columns=['code', 'site_url'],
+        )
+        await conn.execute("ANALYZE codes")
+    finally:
+        await conn.close()
+
+
+async def database_totals():
+    conn = await asyncpg.connect(**bot.DB_CONNECT_KWARGS)
+    try:
+        return await conn.fetchrow('''
+            SELECT (SELECT count(*) FROM used_codes) AS issued,
+                   (SELECT count(*) - count(DISTINCT code) FROM used_codes) AS duplicate_codes,
+                   (SELECT count(*) - count(DISTINCT user_id) FROM used_codes) AS duplicate_users,
+                   (SELECT count(*) FROM codes) AS remaining
+        ''')
+    finally:
+        await conn.close()
+
+
+async def start_bot(env: dict):
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(common.ROOT, 'bot.py'), env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=open(BOT_LOG, 'w'),
+    )
+    async with aiohttp.ClientSession() as session:
+        for _ in range(300):
+            if process.returncode is not None:
+                raise RuntimeError(f"Бот завершился при запуске, см. {BOT_LOG}")
+            try:
+                async with session.get(f"{BOT_URL}/stats") as response:
+                    if response.status == 200:
+                        return process
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Бот не запустился за 30 секунд")
+
+
+async def stop_bot(process):
+    if process.returncode is None:
+        process.terminate()
+        await process.wait()
+
+
+# Как и Telegram, повторяем доставку обновления, если вебхук ответил не 200 или
+# соединение не удалось: с экспоненциальной паузой от redelivery_delay до REDELIVERY_MAX_DELAY
+REDELIVERY_MAX_DELAY = 10.0
+
+
+async def send_traffic(session, traffic, rate: float, concurrency: int, max_redeliveries: int, redelivery_delay: float):
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': bot.WEBHOOK_SECRET}
+    latencies = []
+    statuses = Counter()  # Все ответы, включая повторные доставки
+    first_tap = {}
+    redelivered = Counter()  # Число повторных доставок -> обновлений
+    undelivered = 0
+
+    async def post(update, user_id, kind):
+        nonlocal undelivered
+        if kind == 'get_code':
+            first_tap.setdefault(user_id, time.time())
+        for attempt in range(max_redeliveries + 1):
+            if attempt:
+                await asyncio.sleep(min(REDELIVERY_MAX_DELAY, redelivery_delay * 2 ** (attempt - 1)))
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(f"{BOT_URL}{bot.WEBHOOK_PATH}", json=update, headers=headers) as response:
+                        await response.read()
+                        status = response.status
+                except aiohttp.ClientError:
+                    status = 'error'
+                latencies.append(time.perf_counter() - started)
+            statuses[status] += 1
+            if status == 200:
+                redelivered[attempt] += 1
+                return
+        undelivered += 1
+
+    tasks = []
+    started = time.perf_counter()
+    for i, (update, user_id, kind) in enumerate(traffic):
+        # Открытая модель нагрузки: обновление уходит по расписанию, не дожидаясь ответов
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(post(update, user_id, kind)))
+    await asyncio.gather(*tasks)
+    return time.perf_counter() - started, latencies, statuses, first_tap, redelivered, undelivered
+
+
+# Ждем, пока бот разберет очереди и новые сообщения перестанут появляться
+async def wait_settled(session, api, timeout: float):
+    deadline = time.monotonic() + timeout
+    last_count = -1
+    while time.monotonic() < deadline:
+        async with session.get(f"{BOT_URL}/stats") as response:
+            stats = await response.json()
+        idle = stats["update_queue"]["depth"] == 0 and stats["outbox"]["depth"] == 0
+        if idle and len(api.messages) == last_count:
+            return stats
+        last_count = len(api.messages)
+        await asyncio.sleep(0.5)
+    async with session.get(f"{BOT_URL}/stats") as response:
+        return await response.json()
+
+
+def analyze_messages(api, first_tap: dict):
+    answered = {}
+    delivered = defaultdict(set)
+    for message in api.messages:
+        if message["method"] != 'editMessageText' or message["text"].startswith(PROGRESS_PREFIX):
+            continue
+        chat_id = message["chat_id"]
+        if chat_id in first_tap and chat_id not in answered:
+            answered[chat_id] = message["at"] - first_tap[chat_id]
+        match = CODE_PATTERN.search(message["text"])
+        if match:
+            delivered[match.group(1)].add(chat_id)
+    duplicates = sum(1 for chats in delivered.values() if len(chats) > 1)
+    return answered, len(delivered), duplicates
+
+
+async def run(args):
+    non_subscribers = {USER_ID_BASE + i for i in range(args.users) if i % 100 < args.non_subscribers * 100}
+    api = fake_bot_api.FakeBotAPI(
+        latency=args.api_latency, jitter=args.api_jitter, retry_after_rate=args.retry_after_rate,
+        members={"statuses": {str(user_id): 'left' for user_id in non_subscribers}}, seed=1,
+    )
+    runner = await fake_bot_api.start_server(api, port=args.api_port)
+    await prepare_database(args.inventory)
+
+    env = dict(os.environ)
+    env.update({
+        'BOT_API_URL': f"http://127.0.0.1:{args.api_port}",
+        'WEBHOOK_URL': BOT_URL,
+        'LOG_LEVEL': 'WARNING',
+    })
+    env.update(dict(item.split('=', 1) for item in args.bot_env))
+    process = await start_bot(env)
+    traffic, repeaters = build_traffic(args)
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            send_seconds, latencies, statuses, first_tap, redelivered, undelivered = await send_traffic(
+                session, traffic, args.rate, args.concurrency, args.max_redeliveries, args.redelivery_delay,
+            )
+            bot_stats = await wait_settled(session, api, args.settle_timeout)
+    finally:
+        await stop_bot(process)
+        await runner.cleanup()
+
+    answered, delivered_codes, delivered_duplicates = analyze_messages(api, first_tap)
+    totals = await database_totals()
+    subscribers = args.users - len(non_subscribers)
+    report = {
+        "params": {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "updates_sent": len(traffic),
+        "send_seconds": round(send_seconds, 3),
+        "throughput_rps": round(len(traffic) / send_seconds, 1),
+        "webhook_statuses": {str(status): count for status, count in statuses.items()},
+        "redeliveries": {str(attempts): count for attempts, count in sorted(redelivered.items())},
+        "undelivered": undelivered,
+        "webhook_latency": common.summarize(latencies),
+        "time_to_answer": common.summarize(list(answered.values())),
+        "users_tapped": len(first_tap),
+        "users_answered": len(answered),
+        "repeat_tappers": len(repeaters),
+        "non_subscribers": len(non_subscribers),
+        "inventory": args.inventory,
+        "codes_issued": totals["issued"],
+        "codes_remaining": totals["remaining"],
+        "expected_issued": min(args.inventory, subscribers),
+        "codes_delivered": delivered_codes,
+        "duplicates_issued": totals["duplicate_codes"] + totals["duplicate_users"] + delivered_duplicates,
+        "fake_api": {"requests": dict(api.requests), "retry_after_injected": api.retry_after_injected},
+        "bot": {key: bot_stats.get(key) for key in (
+            'update_queue', 'outbox', 'callback_ack', 'throttling', 'code_requests', 'update_decoder',
+        )},
+    }
+    return report
+
+
+# Регрессия — рост задержки или падение пропускной способности больше tolerance
+def compare(report: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for section in ('webhook_latency', 'time_to_answer'):
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = baseline[section].get(key), report[section].get(key)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{section}.{key}: {old} -> {new}")
+    if report["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput_rps: {baseline['throughput_rps']} -> {report['throughput_rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--inventory', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=2000, help='обновлений в секунду')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--non-subscribers', type=float, default=0.1, help='доля пользователей')
+    parser.add_argument('--repeat-fraction', type=float, default=0.2, help='доля пользователей с повторными нажатиями')
+    parser.add_argument('--repeat-taps', type=int, default=3)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--api-latency', type=float, default=30, help='мс')
+    parser.add_argument('--api-jitter', type=float, default=10, help='мс')
+    parser.add_argument('--retry-after-rate', type=float, default=0.0)
+    parser.add_argument('--max-redeliveries', type=int, default=20)
+    parser.add_argument('--redelivery-delay', type=float, default=0.5, help='секунды, первая пауза перед повтором')
+    parser.add_argument('--settle-timeout', type=float, default=120)
+    parser.add_argument('--bot-env', action='append', default=[], help='KEY=VALUE для процесса бота')
+    parser.add_argument('--output', help='сохранить отчет как базовую линию')
+    parser.add_argument('--baseline', help='сравнить с базовой линией')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    failed = False
+    if report["duplicates_issued"]:
+        print(f"ОШИБКА: повторно выдано кодов: {report['duplicates_issued']}", file=sys.stderr)
+        failed = True
+    if report["codes_issued"] != report["expected_issued"]:
+        print(f"ОШИБКА: выдано кодов {report['codes_issued']}, ожидалось {report['expected_issued']}", file=sys.stderr)
+        failed = True
+    if report["users_answered"] < args.users:
+        print(f"ОШИБКА: ответ получили {report['users_answered']} из {args.users} пользователей", file=sys.stderr)
+        failed = True
+    if report["undelivered"]:
+        print(f"ОШИБКА: не доставлено обновлений: {report['undelivered']}", file=sys.stderr)
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Регрессия: {regression}", file=sys.stderr)
+        failed = failed or bool(regressions)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# Локальная заглушка Telegram Bot API для нагрузочных и офлайн-тестов.
+#
+# Бот направляется на нее через BOT_API_URL (например, http://127.0.0.1:8081).
+# Поддерживаются getMe, getChatMember, sendMessage, editMessageText, answerCallbackQuery,
+# setWebhook и getWebhookInfo. Настраиваются:
+#   --latency / --jitter     задержка ответа в миллисекундах (равномерно latency ± jitter);
+#   --retry-after-rate       доля запросов отправки, на которые отвечаем 429 с retry_after;
+#   --members                файл с подписками: {"default": "member", "left_percent": 0,
+#                            "statuses": {"12345": "left"}}; left_percent — доля пользователей
+#                            (по user_id % 100), которые не подписаны на канал.
+# Служебные адреса: GET /_stats (счетчики), GET /_messages (последние отправленные
+# и измененные сообщения), POST /_reset.
+#
+#   python bench/fake_bot_api.py --port 8081 --latency 50 --jitter 20 --retry-after-rate 0.01
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, deque
+
+from aiohttp import web
+
+BOT_USER = {"id": 7000000001, "is_bot": True, "first_name": "Bonus Codes", "username": "bonuscodes_fake_bot"}
+SEND_METHODS = ('sendMessage', 'editMessageText', 'answerCallbackQuery')
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, retry_after_rate: float = 0.0,
+                 retry_after: int = 1, members: dict = None, record: int = 100000, seed: int = None):
+        members = members or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.default_status = members.get('default', 'member')
+        self.left_percent = members.get('left_percent', 0)
+        self.statuses = {int(user_id): status for user_id, status in members.get('statuses', {}).items()}
+        self.random = random.Random(seed)
+        self.methods = {
+            'getMe': self.get_me,
+            'getChatMember': self.get_chat_member,
+            'sendMessage': self.send_message,
+            'editMessageText': self.edit_message_text,
+            'answerCallbackQuery': self.answer_callback_query,
+            'setWebhook': self.set_webhook,
+            'getWebhookInfo': self.get_webhook_info,
+        }
+        self.messages = deque(maxlen=record)
+        self.reset()
+
+    def reset(self):
+        self.requests = Counter()
+        self.retry_after_injected = 0
+        self.messages.clear()
+        self.webhook = {"url": "", "secret_token": None, "allowed_updates": None}
+        self._message_ids = itertools.count(1)
+
+    def status_for(self, user_id: int):
+        status = self.statuses.get(user_id)
+        if status is not None:
+            return status
+        if user_id % 100 < self.left_percent:
+            return 'left'
+        return self.default_status
+
+    def _message(self, params: dict, message_id: int):
+        chat_id = int(params['chat_id'])
+        return {
+            "message_id": message_id,
+            "from": BOT_USER,
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+            "date": int(time.time()),
+            "text": params.get('text', ''),
+        }
+
+    def _record(self, method: str, params: dict, message_id: int):
+        self.messages.append({
+            "method": method,
+            "chat_id": int(params['chat_id']),
+            "message_id": message_id,
+            "text": params.get('text', ''),
+            "at": time.time(),
+        })
+
+    def get_me(self, params):
+        return BOT_USER
+
+    def get_chat_member(self, params):
+        user_id = int(params['user_id'])
+        member = {"user": {"id": user_id, "is_bot": False, "first_name": "User"}, "status": self.status_for(user_id)}
+        if member["status"] == 'kicked':
+            member["until_date"] = 0
+        return member
+
+    def send_message(self, params):
+        message_id = next(self._message_ids)
+        self._record('sendMessage', params, message_id)
+        return self._message(params, message_id)
+
+    def edit_message_text(self, params):
+        message_id = int(params['message_id'])
+        self._record('editMessageText', params, message_id)
+        return self._message(params, message_id)
+
+    def answer_callback_query(self, params):
+        return True
+
+    def set_webhook(self, params):
+        allowed_updates = params.get('allowed_updates')
+        self.webhook = {
+            "url": params.get('url', ''),
+            "secret_token": params.get('secret_token'),
+            "allowed_updates": json.loads(allowed_updates) if allowed_updates else None,
+        }
+        return True
+
+    def get_webhook_info(self, params):
+        info = {"url": self.webhook["url"], "has_custom_certificate": False, "pending_update_count": 0}
+        if self.webhook["allowed_updates"] is not None:
+            info["allowed_updates"] = self.webhook["allowed_updates"]
+        return info
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        params = dict(request.query)
+        if request.content_type == 'application/json':
+            params.update(await request.json())
+        else:
+            params.update(await request.post())
+        self.requests[method] += 1
+
+        if self.latency or self.jitter:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            await asyncio.sleep(delay / 1000)
+
+        handler = self.methods.get(method)
+        if handler is None:
+            return web.json_response(
+                {"ok": False, "error_code": 404, "description": "Not Found: method not found"}, status=404
+            )
+        if method in SEND_METHODS and self.random.random() < self.retry_after_rate:
+            self.retry_after_injected += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        return web.json_response({"ok": True, "result": handler(params)})
+
+    async def stats(self, request: web.Request):
+        return web.json_response({
+            "requests": dict(self.requests),
+            "retry_after_injected": self.retry_after_injected,
+            "messages": len(self.messages),
+            "webhook": self.webhook,
+        })
+
+    async def list_messages(self, request: web.Request):
+        return web.json_response(list(self.messages))
+
+    async def reset_state(self, request: web.Request):
+        self.reset()
+        return web.json_response({"ok": True})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_get('/_messages', self.list_messages)
+        app.router.add_post('/_reset', self.reset_state)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+
+# Запуск в текущем цикле событий (для бенчмарков, которые поднимают заглушку сами)
+async def start_server(api: FakeBotAPI, host: str = '127.0.0.1', port: int = 8081):
+    runner = web.AppRunner(api.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def load_members(path: str):
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='мс')
+    parser.add_argument('--jitter', type=float, default=0.0, help='мс')
+    parser.add_argument('--retry-after-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1, help='секунды')
+    parser.add_argument('--members', help='JSON с подписками на канал')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(
+        latency=args.latency, jitter=args.jitter,
+        retry_after_rate=args.retry_after_rate, retry_after=args.retry_after,
+        members=load_members(args.members), seed=args.seed,
+    )
+    web.run_app(api.make_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
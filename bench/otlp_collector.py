@@ -0,0 +1,59 @@
+# Заглушка коллектора OTLP/HTTP для проверки экспорта трасс без Jaeger/Tempo.
+#
+# Принимает POST /v1/traces в формате OTLP JSON и печатает по строке JSON на трассу:
+# trace_id, длительность корневого отрезка update и длительности дочерних отрезков.
+# С --output дописывает тела запросов в файл (JSON Lines).
+#
+#   python bench/otlp_collector.py --port 4318
+#   TRACE_EXPORT_URL=http://127.0.0.1:4318 python bot.py
+import argparse
+import json
+from collections import defaultdict
+
+from aiohttp import web
+
+
+def summarize(payload):
+    traces = defaultdict(dict)
+    for resource_spans in payload.get('resourceSpans', []):
+        for scope_spans in resource_spans.get('scopeSpans', []):
+            for span in scope_spans.get('spans', []):
+                duration_ms = (int(span['endTimeUnixNano']) - int(span['startTimeUnixNano'])) / 1e6
+                trace = traces[span['traceId']]
+                if 'parentSpanId' in span:
+                    trace.setdefault('spans', []).append({"name": span['name'], "duration_ms": round(duration_ms, 3)})
+                else:
+                    trace['duration_ms'] = round(duration_ms, 3)
+                    trace['attributes'] = {
+                        attribute['key']: next(iter(attribute['value'].values()))
+                        for attribute in span.get('attributes', [])
+                    }
+    return traces
+
+
+def make_app(output: str = None):
+    async def receive(request: web.Request):
+        payload = await request.json()
+        if output:
+            with open(output, 'a') as f:
+                f.write(json.dumps(payload) + '\n')
+        for trace_id, trace in summarize(payload).items():
+            print(json.dumps({"trace_id": trace_id, **trace}, ensure_ascii=False), flush=True)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post('/v1/traces', receive)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4318)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    web.run_app(make_app(args.output), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,48 @@
 import asyncpg
+import bisect
+import copy
+import csv
+import hashlib
+import hmac
+import ipaddress
+import json
+import math
 import logging
+import io
 import os
+import queue
+import re
+import socket
+import tempfile
+import time
+from array import array
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+import aiohttp
 import asyncio
-from aiogram.utils.exceptions import ChatNotFound
+import atexit
+import functools
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from aiogram.utils.exceptions import ChatNotFound, MessageNotModified, RetryAfter
+from aiogram.utils.payload import prepare_arg
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+
+try:
+    # Необязательный быстрый разбор JSON для тела вебхука
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Загрузка переменных из окружения
 API_TOKEN = os.getenv('API_TOKEN')
@@ -21,6 +55,95 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_NAME = os.getenv('DB_NAME')
 DB_HOST = os.getenv('DB_HOST', 'localhost')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+BOT_API_URL = os.getenv('BOT_API_URL', '')  # Свой сервер Bot API (например, bench/fake_bot_api.py); пусто — api.telegram.org
+
+# Настройки пула соединений с базой данных
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '5'))  # Секунды ожидания свободного соединения
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '10'))
+# Режим для PgBouncer в режиме transaction/statement pooling: кеш подготовленных
+# запросов отключен, горячие запросы не подготавливаются заранее
+DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', '0') == '1'
+
+# Резерв кодов в памяти процесса (0 — выключен, коды выдаются напрямую из базы)
+CODE_RESERVOIR_SIZE = int(os.getenv('CODE_RESERVOIR_SIZE', '0'))
+CODE_RESERVOIR_LOW_WATER = int(os.getenv('CODE_RESERVOIR_LOW_WATER', str(CODE_RESERVOIR_SIZE // 4)))
+CODE_LEASE_TTL = int(os.getenv('CODE_LEASE_TTL', '120'))  # Секунды, после которых аренда умершей реплики возвращается
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+
+CODES_PAGE_SIZE = int(os.getenv('CODES_PAGE_SIZE', '30'))  # Кодов на странице /show_codes
+
+# Фильтр получивших код пользователей в памяти: exact, bloom или off
+ISSUED_FILTER_MODE = os.getenv('ISSUED_FILTER_MODE', 'exact')
+ISSUED_FILTER_CAPACITY = int(os.getenv('ISSUED_FILTER_CAPACITY', '1000000'))  # Ожидаемое число записей для bloom
+ISSUED_FILTER_FP_RATE = float(os.getenv('ISSUED_FILTER_FP_RATE', '0.001'))  # Доля ложных срабатываний bloom
+
+# Кэш проверки подписки: отдельное время жизни для подписанных и неподписанных
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '100000'))
+SUBSCRIPTION_POSITIVE_TTL = float(os.getenv('SUBSCRIPTION_POSITIVE_TTL', '300'))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '15'))
+SUBSCRIPTION_RETRIES = int(os.getenv('SUBSCRIPTION_RETRIES', '2'))  # Повторы для только что подписавшихся
+SUBSCRIPTION_RETRY_DELAY = float(os.getenv('SUBSCRIPTION_RETRY_DELAY', '0.5'))  # Первая задержка, дальше удваивается
+CHANNEL_MEMBERS_SYNC_INTERVAL = float(os.getenv('CHANNEL_MEMBERS_SYNC_INTERVAL', '5'))  # Синхронизация подписчиков между репликами
+
+# Типы обновлений, которые Telegram присылает на вебхук (chat_member по умолчанию не приходит)
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
+# Ограничение частоты запросов пользователей (токенов в секунду и размер запаса)
+THROTTLE_START_RATE = float(os.getenv('THROTTLE_START_RATE', '0.5'))
+THROTTLE_START_BURST = int(os.getenv('THROTTLE_START_BURST', '3'))
+THROTTLE_GET_CODE_RATE = float(os.getenv('THROTTLE_GET_CODE_RATE', '0.5'))
+THROTTLE_GET_CODE_BURST = int(os.getenv('THROTTLE_GET_CODE_BURST', '3'))
+THROTTLE_GLOBAL_RATE = float(os.getenv('THROTTLE_GLOBAL_RATE', '500'))  # На обработчик для всех пользователей вместе
+THROTTLE_GLOBAL_BURST = int(os.getenv('THROTTLE_GLOBAL_BURST', '1000'))
+# Общие лимиты отдельных обработчиков; по умолчанию THROTTLE_GLOBAL_RATE/BURST
+THROTTLE_START_GLOBAL_RATE = float(os.getenv('THROTTLE_START_GLOBAL_RATE', str(THROTTLE_GLOBAL_RATE)))
+THROTTLE_START_GLOBAL_BURST = int(os.getenv('THROTTLE_START_GLOBAL_BURST', str(THROTTLE_GLOBAL_BURST)))
+THROTTLE_GET_CODE_GLOBAL_RATE = float(os.getenv('THROTTLE_GET_CODE_GLOBAL_RATE', str(THROTTLE_GLOBAL_RATE)))
+THROTTLE_GET_CODE_GLOBAL_BURST = int(os.getenv('THROTTLE_GET_CODE_GLOBAL_BURST', str(THROTTLE_GLOBAL_BURST)))
+THROTTLE_IDLE_TTL = float(os.getenv('THROTTLE_IDLE_TTL', '60'))  # Через сколько секунд простоя удаляется счетчик пользователя
+THROTTLE_COOLDOWN = float(os.getenv('THROTTLE_COOLDOWN', '10'))  # Не чаще одного ответа "слишком часто" за это время
+
+# Исходящие запросы к Bot API: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '28'))
+OUTBOX_GLOBAL_BURST = int(os.getenv('OUTBOX_GLOBAL_BURST', '30'))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', '3'))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '8'))
+OUTBOX_DIRECT_WORKERS = int(os.getenv('OUTBOX_DIRECT_WORKERS', '16'))  # Для запросов без chat_id (ответы на нажатия)
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '3'))  # Повторы после RetryAfter
+
+# Очередь обновлений вебхука и обработчики
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))  # При переполнении вебхук отвечает 503
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '32'))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '10'))  # Секунды на обработку очереди при остановке
+# Первый запрос к Bot API, сделанный при обработке обновления, возвращается в ответе вебхука
+WEBHOOK_REPLY_IN_RESPONSE = os.getenv('WEBHOOK_REPLY_IN_RESPONSE', '0') == '1'
+WEBHOOK_REPLY_WAIT = float(os.getenv('WEBHOOK_REPLY_WAIT', '1'))  # Сколько секунд вебхук ждет этот запрос
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token. По умолчанию выводится из токена
+# бота, чтобы все реплики регистрировали вебхук с одним и тем же значением
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{API_TOKEN}".encode()).hexdigest()
+# Сети, из которых принимаются запросы к вебхуку, через запятую (например, подсети
+# Telegram 149.154.160.0/20,91.108.4.0/22). Пусто — источник не проверяется. За прокси
+# адрес клиента берется из X-Forwarded-For, только если uvicorn запущен с --proxy-headers
+WEBHOOK_ALLOWED_NETWORKS = os.getenv('WEBHOOK_ALLOWED_NETWORKS', '')
+
+# Отсев повторно доставленных обновлений по update_id
+UPDATE_DEDUP_WINDOW = int(os.getenv('UPDATE_DEDUP_WINDOW', '100000'))  # Последних update_id в памяти
+UPDATE_DEDUP_DB = os.getenv('UPDATE_DEDUP_DB', '0') == '1'  # Общий отсев для нескольких реплик через базу
+UPDATE_DEDUP_DB_TTL = int(os.getenv('UPDATE_DEDUP_DB_TTL', '3600'))  # Секунды хранения update_id в базе
+
+# Логирование
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # json или text
+LOG_UPDATE_SAMPLE_RATE = float(os.getenv('LOG_UPDATE_SAMPLE_RATE', '0.01'))  # Доля отладочных строк по обновлениям
+
+# Трассировка обновлений
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', '2'))  # Секунды; медленнее — в журнал медленных обновлений
+TRACE_EXPORT_URL = os.getenv('TRACE_EXPORT_URL', '')  # OTLP/HTTP коллектор, например http://127.0.0.1:4318; пусто — без экспорта
+TRACE_EXPORT_INTERVAL = float(os.getenv('TRACE_EXPORT_INTERVAL', '5'))  # Секунды между отправками
+TRACE_EXPORT_BUFFER = int(os.getenv('TRACE_EXPORT_BUFFER', '10000'))  # Трасс в ожидании отправки, старые вытесняются
 
 # Проверки на обязательные параметры
 if not API_TOKEN:
@@ -38,254 +161,2438 @@ if not DB_NAME:
 if not WEBHOOK_URL:
     raise ValueError("Не задан WEBHOOK_URL (например, https://ваш-домен.onrender.com)")
 
-bot = Bot(token=API_TOKEN)
+# Все запросы к Bot API проходят через request(); время каждого запроса пишется
+# в гистограмму bot_api_seconds по имени метода
+class MeteredBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        finally:
+            bot_api_seconds.observe(method, time.perf_counter() - started)
+            record_span('api:' + method, started)
+
+bot = MeteredBot(
+    token=API_TOKEN,
+    server=TelegramAPIServer.from_base(BOT_API_URL) if BOT_API_URL else TELEGRAM_PRODUCTION,
+)
 Bot.set_current(bot)  # Установить текущий бот
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
-dp.middleware.setup(LoggingMiddleware())
 
-logging.basicConfig(level=logging.DEBUG)
+# Одна строка JSON на запись; поля из extra= попадают в запись как есть
+class JsonFormatter(logging.Formatter):
+    STANDARD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.STANDARD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Трасса обновления, которое сейчас обрабатывается (UpdateTrace ниже)
+current_trace = ContextVar('current_trace', default=None)
+
+# Аргументы сообщения подставляются до передачи в другой поток (объекты могут измениться),
+# трассировка исключения сохраняется отдельно от текста, чтобы попасть в поле exc.
+# Записи, сделанные при обработке обновления, получают его trace_id.
+class LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        trace = current_trace.get()
+        if trace is not None:
+            record.trace_id = trace.trace_id
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+# Записи из цикла событий только кладутся в очередь, а форматирование в JSON и вывод
+# в stderr выполняет фоновый поток QueueListener. Сообщения передаются в %-стиле:
+# для отключенных уровней строка не собирается вообще.
+def setup_logging():
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(LogQueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+# Отладочные строки по каждому обновлению: пишется одна из каждых 1 / rate,
+# проверка уровня выполняется до счетчика и до сборки строки
+class SampledLogger:
+    def __init__(self, logger: logging.Logger, rate: float):
+        self.logger = logger
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self.seen = 0
+
+    def debug(self, msg, *args):
+        if not self.every or not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.seen += 1
+        if self.seen % self.every == 0:
+            self.logger.debug(msg, *args, extra={"sample_every": self.every})
+
+update_log = SampledLogger(logger, LOG_UPDATE_SAMPLE_RATE)
+
+# Трасса одного обновления: создается в вебхуке, передается обработчику через очередь
+# и current_trace. Отрезки (spans) хранятся как (имя, начало от старта трассы, длительность).
+class UpdateTrace:
+    __slots__ = ('trace_id', 'update_id', 'started', 'started_wall', 'spans')
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.update_id = None
+        self.started = time.perf_counter()
+        self.started_wall = time.time()
+        self.spans = []
+
+    def add(self, name: str, started: float, duration: float):
+        self.spans.append((name, started - self.started, duration))
+
+    def breakdown(self):
+        return [
+            {"name": name, "start_ms": round(offset * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+            for name, offset, duration in self.spans
+        ]
+
+# Записывает отрезок в трассу текущего обновления, если она есть
+def record_span(name: str, started: float):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, started, time.perf_counter() - started)
+
+# Отрезок трассы на все время выполнения корутины
+def traced(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record_span(name, started)
+        return wrapper
+    return decorator
+
+slow_update_log = logging.getLogger('bot.slow_updates')
+
+# Завершение трасс: обновления дольше slow_threshold пишутся в журнал медленных
+# обновлений со всеми отрезками. С TRACE_EXPORT_URL трассы раз в export_interval
+# отправляются пачкой в формате OTLP/HTTP JSON (/v1/traces).
+class Tracer:
+    def __init__(self, slow_threshold: float, export_url: str, export_interval: float, export_buffer: int):
+        self.slow_threshold = slow_threshold
+        self.export_url = export_url.rstrip('/') + '/v1/traces' if export_url else None
+        self.export_interval = export_interval
+        self.pending = deque(maxlen=export_buffer)
+        self.finished = 0
+        self.slow = 0
+        self.exported = 0
+        self.export_failed = 0
+        self._session = None
+        self._task = None
+
+    def finish(self, trace: UpdateTrace):
+        duration = time.perf_counter() - trace.started
+        self.finished += 1
+        if duration >= self.slow_threshold:
+            self.slow += 1
+            slow_update_log.warning(
+                "Медленное обновление %s: %.1f мс", trace.update_id, duration * 1000,
+                extra={"trace_id": trace.trace_id, "update_id": trace.update_id,
+                       "duration_ms": round(duration * 1000, 3), "spans": trace.breakdown()},
+            )
+        if self.export_url is not None:
+            self.pending.append((trace, duration))
+
+    async def start(self):
+        if self.export_url is not None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+            self._task = asyncio.create_task(self._export_loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self._export()
+        await self._session.close()
+
+    async def _export_loop(self):
+        while True:
+            await asyncio.sleep(self.export_interval)
+            await self._export()
+
+    async def _export(self):
+        if not self.pending:
+            return
+        batch = list(self.pending)
+        self.pending.clear()
+        try:
+            async with self._session.post(self.export_url, json=self._to_otlp(batch)) as response:
+                response.raise_for_status()
+            self.exported += len(batch)
+        except Exception as e:
+            self.export_failed += len(batch)
+            logger.warning("Не удалось отправить трассы: %s", e)
+
+    # Корневой отрезок update и дочерние отрезки трассы, время — в наносекундах Unix
+    @staticmethod
+    def _to_otlp(batch):
+        spans = []
+        for trace, duration in batch:
+            root_id = os.urandom(8).hex()
+            start_ns = int(trace.started_wall * 1e9)
+            spans.append({
+                "traceId": trace.trace_id, "spanId": root_id, "name": "update", "kind": 2,
+                "startTimeUnixNano": str(start_ns), "endTimeUnixNano": str(start_ns + int(duration * 1e9)),
+                "attributes": [{"key": "update_id", "value": {"intValue": str(trace.update_id)}}],
+            })
+            for name, offset, span_duration in trace.spans:
+                span_start = start_ns + int(offset * 1e9)
+                spans.append({
+                    "traceId": trace.trace_id, "spanId": os.urandom(8).hex(), "parentSpanId": root_id,
+                    "name": name, "kind": 1,
+                    "startTimeUnixNano": str(span_start), "endTimeUnixNano": str(span_start + int(span_duration * 1e9)),
+                })
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "bonuscodes-bot"}}]},
+            "scopeSpans": [{"scope": {"name": "bot"}, "spans": spans}],
+        }]}
+
+    def stats(self):
+        return {
+            "finished": self.finished,
+            "slow": self.slow,
+            "slow_threshold_ms": self.slow_threshold * 1000,
+            "export_pending": len(self.pending),
+            "exported": self.exported,
+            "export_failed": self.export_failed,
+        }
+
+tracer = Tracer(SLOW_UPDATE_THRESHOLD, TRACE_EXPORT_URL, TRACE_EXPORT_INTERVAL, TRACE_EXPORT_BUFFER)
+
 # Функции для работы с базой данных
-async def get_db_connection():
-    return await asyncpg.connect(
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME,
-        host=DB_HOST,
+db_pool = None  # Общий пул соединений процесса, создается в lifespan приложения
+
+DB_CONNECT_KWARGS = dict(
+    user=DB_USER,
+    password=DB_PASSWORD,
+    database=DB_NAME,
+    host=DB_HOST,
+)
+
+# Реестр именованных запросов. Обработчики обращаются к запросам по имени, а горячие
+# запросы подготавливаются один раз при создании соединения пула и попадают в его кеш:
+# первый запрос пользователя не платит за разбор и план. Connection.prepare() кеш
+# не заполняет, поэтому используется внутренний _get_statement(); он и завершение
+# подготовки без Sync (см. prepare) проверены на asyncpg 0.32.0, версия закреплена
+# в requirements.txt. В режиме DB_PGBOUNCER кеш отключен, и запросы выполняются
+# как неименованные.
+class StatementRegistry:
+    def __init__(self, cache_enabled: bool):
+        self.cache_enabled = cache_enabled
+        self.queries = {}
+        self.hot = []
+        self.prepared_connections = 0
+
+    def register(self, name: str, query: str, hot: bool = True):
+        if name in self.queries:
+            raise ValueError(f"Запрос {name} уже зарегистрирован")
+        self.queries[name] = query
+        if hot:
+            self.hot.append(name)
+
+    async def prepare(self, conn: asyncpg.Connection):
+        if not self.cache_enabled:
+            return
+        for name in self.hot:
+            await conn._get_statement(self.queries[name], None)
+        # Подготовка не завершает протокол сообщением Sync: до следующего запроса соединение
+        # держит открытую транзакцию с блокировками таблиц, поэтому завершаем ее явно
+        await conn.execute('SELECT 1')
+        self.prepared_connections += 1
+
+    # Время выполнения пишется в гистограмму db_query_seconds по имени запроса
+    async def _run(self, method, name: str, args):
+        started = time.perf_counter()
+        try:
+            return await method(self.queries[name], *args)
+        finally:
+            db_query_seconds.observe(name, time.perf_counter() - started)
+            record_span('db:' + name, started)
+
+    async def fetch(self, conn, name: str, *args):
+        return await self._run(conn.fetch, name, args)
+
+    async def fetchrow(self, conn, name: str, *args):
+        return await self._run(conn.fetchrow, name, args)
+
+    async def fetchval(self, conn, name: str, *args):
+        return await self._run(conn.fetchval, name, args)
+
+    async def execute(self, conn, name: str, *args):
+        return await self._run(conn.execute, name, args)
+
+    # Построчное чтение серверным курсором (нужна транзакция); в гистограмму и трассу
+    # попадает время всего чтения
+    async def cursor(self, conn, name: str, *args, prefetch: int = None):
+        started = time.perf_counter()
+        try:
+            async for row in conn.cursor(self.queries[name], *args, prefetch=prefetch):
+                yield row
+        finally:
+            db_query_seconds.observe(name, time.perf_counter() - started)
+            record_span('db:' + name, started)
+
+    def stats(self):
+        return {
+            "cache_enabled": self.cache_enabled,
+            "registered": len(self.queries),
+            "hot": len(self.hot),
+            "prepared_connections": self.prepared_connections,
+        }
+
+statements = StatementRegistry(cache_enabled=not DB_PGBOUNCER)
+
+async def create_db_pool():
+    global db_pool
+    db_pool = await asyncpg.create_pool(
+        **DB_CONNECT_KWARGS,
+        init=statements.prepare,
+        statement_cache_size=0 if DB_PGBOUNCER else 100,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
     )
+    logger.info("Пул соединений создан (min=%s, max=%s, pgbouncer=%s)", DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_PGBOUNCER)
+    return db_pool
 
+async def close_db_pool():
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+# Соединение из пула; использовать как `async with get_db_connection() as conn:`
+def get_db_connection():
+    if db_pool is None:
+        raise RuntimeError("Пул соединений с базой данных не создан")
+    return db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+
+# Статистика пула для мониторинга
+def get_pool_stats():
+    if db_pool is None:
+        return {"size": 0, "idle": 0, "in_use": 0, "min_size": DB_POOL_MIN_SIZE, "max_size": DB_POOL_MAX_SIZE}
+    size = db_pool.get_size()
+    idle = db_pool.get_idle_size()
+    return {
+        "size": size,
+        "idle": idle,
+        "in_use": size - idle,
+        "min_size": db_pool.get_min_size(),
+        "max_size": db_pool.get_max_size(),
+    }
+
+# Схема создается отдельным соединением до пула: соединения пула при создании
+# сразу подготавливают запросы к этим таблицам
 async def create_tables():
-    conn = await get_db_connection()
-    await conn.execute(''' 
-        CREATE TABLE IF NOT EXISTS codes (
-            code TEXT PRIMARY KEY, 
-            site_url TEXT
+    conn = await asyncpg.connect(**DB_CONNECT_KWARGS)
+    try:
+        await conn.execute(''' 
+            CREATE TABLE IF NOT EXISTS codes (
+                code TEXT PRIMARY KEY,
+                site_url TEXT
+            )
+        ''')
+        await conn.execute(''' 
+            CREATE TABLE IF NOT EXISTS used_codes (
+                user_id BIGINT PRIMARY KEY,  -- Заменили INTEGER на BIGINT
+                code TEXT,
+                ip_address TEXT
+            )
+        ''')
+        await conn.execute(''' 
+            CREATE INDEX IF NOT EXISTS idx_used_codes_user_id ON used_codes (user_id);
+        ''')
+        await conn.execute(''' 
+            CREATE INDEX IF NOT EXISTS idx_used_codes_ip_address ON used_codes (ip_address);
+        ''')
+        await conn.execute(''' 
+            CREATE INDEX IF NOT EXISTS idx_codes_code ON codes (code);
+        ''')
+        # Аренда кодов репликами для резерва в памяти
+        await conn.execute(''' 
+            ALTER TABLE codes
+                ADD COLUMN IF NOT EXISTS leased_by TEXT,
+                ADD COLUMN IF NOT EXISTS leased_at TIMESTAMPTZ
+        ''')
+        await conn.execute(''' 
+            CREATE INDEX IF NOT EXISTS idx_codes_leased_by ON codes (leased_by) WHERE leased_by IS NOT NULL;
+        ''')
+        # Подписчики канала по событиям chat_member
+        await conn.execute(''' 
+            CREATE TABLE IF NOT EXISTS channel_members (
+                user_id BIGINT PRIMARY KEY,
+                is_member BOOLEAN NOT NULL,
+                status TEXT,
+                changed_at TIMESTAMPTZ NOT NULL,  -- Время события в Telegram
+                recorded_at TIMESTAMPTZ NOT NULL DEFAULT now()  -- Время записи, для синхронизации реплик
+            )
+        ''')
+        await conn.execute(''' 
+            CREATE INDEX IF NOT EXISTS idx_channel_members_recorded_at ON channel_members (recorded_at);
+        ''')
+        if UPDATE_DEDUP_DB:
+            await conn.execute(''' 
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id BIGINT PRIMARY KEY,
+                    received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            ''')
+            await conn.execute(''' 
+                CREATE INDEX IF NOT EXISTS idx_processed_updates_received_at ON processed_updates (received_at);
+            ''')
+    finally:
+        await conn.close()
+
+# Результаты выдачи кода
+CLAIM_CLAIMED = 'claimed'
+CLAIM_SOLD_OUT = 'sold_out'
+CLAIM_ALREADY_CLAIMED = 'already_claimed'
+
+# Выдача кода одним запросом: код удаляется из codes и записывается в used_codes
+# в одной транзакции. SKIP LOCKED позволяет параллельным запросам забирать разные
+# строки, а не ждать блокировку первой.
+statements.register('claim_code', '''
+    WITH picked AS (
+        SELECT code FROM codes
+        WHERE leased_by IS NULL
+          AND NOT EXISTS (SELECT 1 FROM used_codes WHERE user_id = $1 OR ip_address = $2)
+        ORDER BY code
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ),
+    claimed AS (
+        DELETE FROM codes USING picked
+        WHERE codes.code = picked.code
+        RETURNING codes.code, codes.site_url
+    ),
+    recorded AS (
+        INSERT INTO used_codes (user_id, code, ip_address)
+        SELECT $1, code, $2 FROM claimed
+        RETURNING code
+    )
+    SELECT claimed.code, claimed.site_url,
+           EXISTS (SELECT 1 FROM used_codes WHERE user_id = $1 OR ip_address = $2) AS already_claimed
+    FROM (SELECT 1) AS one
+    LEFT JOIN claimed ON TRUE
+''')
+
+# Функция для выдачи уникального кода пользователю
+async def claim_code(user_id: int, ip_address: str):
+    try:
+        async with get_db_connection() as conn:
+            result = await statements.fetchrow(conn, 'claim_code', user_id, str(ip_address))
+    except asyncpg.UniqueViolationError:
+        # Параллельный запрос этого же пользователя успел записать код первым;
+        # весь запрос откатывается, и наш код остается в базе
+        return CLAIM_ALREADY_CLAIMED, None
+    if result['already_claimed']:
+        return CLAIM_ALREADY_CLAIMED, None
+    if result['code'] is None:
+        return CLAIM_SOLD_OUT, None
+    return CLAIM_CLAIMED, result
+
+# Запросы для резерва кодов: аренда, продление, возврат и выдача арендованного кода
+statements.register('lease_codes', '''
+    UPDATE codes SET leased_by = $1, leased_at = now()
+    WHERE code IN (
+        SELECT code FROM codes
+        WHERE leased_by IS NULL
+        ORDER BY code
+        LIMIT $2
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING code, site_url
+''', hot=False)
+statements.register(
+    'renew_leases', "UPDATE codes SET leased_at = now() WHERE leased_by = $1", hot=False
+)
+statements.register(
+    'release_leases', "UPDATE codes SET leased_by = NULL, leased_at = NULL WHERE leased_by = $1", hot=False
+)
+statements.register('reclaim_expired_leases', '''
+    UPDATE codes SET leased_by = NULL, leased_at = NULL
+    WHERE leased_by IS NOT NULL AND leased_at < now() - make_interval(secs => $1)
+''', hot=False)
+# Выдача из резерва — горячий запрос, только если резерв включен
+statements.register('claim_leased_code', '''
+    WITH claimed AS (
+        DELETE FROM codes
+        WHERE code = $3 AND leased_by = $4
+          AND NOT EXISTS (SELECT 1 FROM used_codes WHERE user_id = $1 OR ip_address = $2)
+        RETURNING code, site_url
+    ),
+    recorded AS (
+        INSERT INTO used_codes (user_id, code, ip_address)
+        SELECT $1, code, $2 FROM claimed
+        RETURNING code
+    )
+    SELECT claimed.code, claimed.site_url,
+           EXISTS (SELECT 1 FROM used_codes WHERE user_id = $1 OR ip_address = $2) AS already_claimed
+    FROM (SELECT 1) AS one
+    LEFT JOIN claimed ON TRUE
+''', hot=CODE_RESERVOIR_SIZE > 0)
+
+# Резерв кодов в памяти реплики. Реплика арендует пачку кодов (leased_by/leased_at),
+# раздает их из очереди и дозаполняет ее в фоне, когда остается меньше low_water.
+# Аренда живой реплики продлевается в фоне; аренда упавшей реплики истекает через
+# lease_ttl и возвращается любой другой репликой, при остановке коды возвращаются сразу.
+class CodeReservoir:
+    def __init__(self, size: int, low_water: int, lease_ttl: int, replica_id: str):
+        self.size = size
+        self.low_water = low_water
+        self.lease_ttl = lease_ttl
+        self.replica_id = replica_id
+        self.queue = asyncio.Queue()
+        self._refill_needed = asyncio.Event()
+        self._task = None
+        self.leased_total = 0
+        self.lost_leases = 0
+        self.fallbacks = 0
+
+    async def start(self):
+        async with get_db_connection() as conn:
+            # Аренды, оставшиеся от прошлого запуска с тем же REPLICA_ID
+            await statements.execute(conn, 'release_leases', self.replica_id)
+        await self._refill()
+        self._task = asyncio.create_task(self._refill_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        async with get_db_connection() as conn:
+            await statements.execute(conn, 'release_leases', self.replica_id)
+
+    async def _refill(self):
+        missing = self.size - self.queue.qsize()
+        if missing <= 0:
+            return
+        async with get_db_connection() as conn:
+            rows = await statements.fetch(conn, 'lease_codes', self.replica_id, missing)
+        for row in rows:
+            self.queue.put_nowait((row['code'], row['site_url']))
+        self.leased_total += len(rows)
+
+    async def _refill_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._refill_needed.wait(), timeout=self.lease_ttl / 3)
+            except asyncio.TimeoutError:
+                pass
+            self._refill_needed.clear()
+            try:
+                async with get_db_connection() as conn:
+                    await statements.execute(conn, 'renew_leases', self.replica_id)
+                    await statements.execute(conn, 'reclaim_expired_leases', self.lease_ttl)
+                if self.queue.qsize() < self.low_water:
+                    await self._refill()
+            except Exception:
+                logger.exception("Ошибка при пополнении резерва кодов")
+
+    async def claim(self, user_id: int, ip_address: str):
+        while True:
+            try:
+                code, site_url = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                # Резерв пуст: будим пополнение и выдаем код напрямую из базы
+                self._refill_needed.set()
+                self.fallbacks += 1
+                return await claim_code(user_id, ip_address)
+            if self.queue.qsize() < self.low_water:
+                self._refill_needed.set()
+            try:
+                async with get_db_connection() as conn:
+                    result = await statements.fetchrow(conn, 'claim_leased_code', user_id, str(ip_address), code, self.replica_id)
+            except asyncpg.UniqueViolationError:
+                self.queue.put_nowait((code, site_url))
+                return CLAIM_ALREADY_CLAIMED, None
+            except Exception:
+                self.queue.put_nowait((code, site_url))
+                raise
+            if result['already_claimed']:
+                self.queue.put_nowait((code, site_url))
+                return CLAIM_ALREADY_CLAIMED, None
+            if result['code'] is None:
+                # Аренда истекла и код забрали — берем следующий
+                self.lost_leases += 1
+                continue
+            return CLAIM_CLAIMED, result
+
+    def stats(self):
+        return {
+            "replica_id": self.replica_id,
+            "available": self.queue.qsize(),
+            "size": self.size,
+            "low_water": self.low_water,
+            "leased_total": self.leased_total,
+            "lost_leases": self.lost_leases,
+            "fallbacks": self.fallbacks,
+        }
+
+code_reservoir = None
+if CODE_RESERVOIR_SIZE > 0:
+    code_reservoir = CodeReservoir(CODE_RESERVOIR_SIZE, CODE_RESERVOIR_LOW_WATER, CODE_LEASE_TTL, REPLICA_ID)
+
+# Массовая загрузка кодов из файла: строки "код,сайт" потоково копируются во временную
+# таблицу через COPY и переносятся в codes с пропуском уже существующих кодов
+IMPORT_LINE_SEPARATOR = re.compile(r'\s*[,;\t]\s*|\s+')
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # Ограничение Bot API на скачивание файлов
+
+def parse_import_line(line: str):
+    parts = IMPORT_LINE_SEPARATOR.split(line.strip(), maxsplit=1)
+    if len(parts) != 2 or not parts[0] or not parts[1]:
+        return None
+    return parts[0], parts[1]
+
+statements.register(
+    'create_codes_import', "CREATE TEMP TABLE codes_import (code TEXT, site_url TEXT) ON COMMIT DROP", hot=False,
+)
+# Уже выданные коды тоже считаются дубликатами, чтобы не выдать их повторно
+statements.register('insert_imported_codes', '''
+    INSERT INTO codes (code, site_url)
+    SELECT DISTINCT ON (code) code, site_url FROM codes_import
+    WHERE NOT EXISTS (SELECT 1 FROM used_codes WHERE used_codes.code = codes_import.code)
+    ON CONFLICT (code) DO NOTHING
+''', hot=False)
+
+async def import_codes(file):
+    counts = {"lines": 0, "inserted": 0, "duplicates": 0, "malformed": 0}
+
+    async def records():
+        for line_number, line in enumerate(io.TextIOWrapper(file, encoding='utf-8-sig', errors='replace'), 1):
+            if not line.strip():
+                continue
+            record = parse_import_line(line)
+            if record is None:
+                counts["malformed"] += 1
+                continue
+            if line_number == 1 and record[0].lower() == 'code':
+                continue  # Заголовок CSV
+            counts["lines"] += 1
+            yield record
+
+    async with get_db_connection() as conn:
+        async with conn.transaction():
+            await statements.execute(conn, 'create_codes_import')
+            await conn.copy_records_to_table('codes_import', records=records(), columns=['code', 'site_url'])
+            result = await statements.execute(conn, 'insert_imported_codes')
+    counts["inserted"] = int(result.split()[-1])
+    counts["duplicates"] = counts["lines"] - counts["inserted"]
+    return counts
+
+# Точное компактное множество id: отсортированный array('q') по 8 байт на id и небольшое
+# множество недавно добавленных id, которое сливается в массив, когда вырастает до 1/32
+# массива. Около 8 МБ на миллион id (плюс до ~2 МБ на еще не слитые id). Слияние идет
+# фоновой задачей порциями по MERGE_CHUNK id: массив копируется срезами без создания
+# Python-чисел, между порциями цикл событий свободен; до замены массива сливаемые id
+# ищутся в отдельном множестве.
+class IssuedIdSet:
+    definitive = True
+    MIN_PENDING = 1024
+    MERGE_CHUNK = 1024
+
+    def __init__(self):
+        self._sorted = array('q')
+        self._pending = set()
+        self._merging = frozenset()
+        self._merge_task = None
+
+    def __contains__(self, value: int):
+        if value in self._pending or value in self._merging:
+            return True
+        index = bisect.bisect_left(self._sorted, value)
+        return index < len(self._sorted) and self._sorted[index] == value
+
+    def __len__(self):
+        return len(self._sorted) + len(self._merging) + len(self._pending)
+
+    def add(self, value: int):
+        if value in self:
+            return
+        self._pending.add(value)
+        if self._merge_task is None and len(self._pending) > max(self.MIN_PENDING, len(self._sorted) // 32):
+            try:
+                self._merge_task = asyncio.get_running_loop().create_task(self._merge_in_background())
+            except RuntimeError:
+                self._merge()
+
+    # Загрузка отсортированных по возрастанию id при старте без промежуточного списка
+    def extend_sorted(self, values):
+        self._merge()
+        for value in values:
+            if not self._sorted or value > self._sorted[-1]:
+                self._sorted.append(value)
+            else:
+                self.add(value)
+
+    def _merge(self):
+        if self._merge_task is not None:
+            self._merge_task.cancel()
+            self._merge_task = None
+        values = sorted(self._pending | self._merging)
+        if values:
+            merged = array('q')
+            start = self._merge_into(merged, self._sorted, 0, values)
+            merged.extend(self._sorted[start:])
+            self._sorted = merged
+            self._pending = set()
+            self._merging = frozenset()
+
+    async def _merge_in_background(self):
+        self._merging = frozenset(self._pending)
+        self._pending = set()
+        base = self._sorted
+        values = sorted(self._merging)
+        merged = array('q')
+        start = 0
+        for offset in range(0, len(values), self.MERGE_CHUNK):
+            start = self._merge_into(merged, base, start, values[offset:offset + self.MERGE_CHUNK])
+            await asyncio.sleep(0)
+        merged.extend(base[start:])
+        self._sorted = merged
+        self._merging = frozenset()
+        self._merge_task = None
+
+    # Дописывает в merged элементы base начиная со start вперемешку с values (отсортированы);
+    # возвращает позицию в base, с которой продолжать
+    @staticmethod
+    def _merge_into(merged, base, start: int, values):
+        for value in values:
+            index = bisect.bisect_left(base, value, start)
+            merged.extend(base[start:index])
+            merged.append(value)
+            start = index
+        return start
+
+    def memory_bytes(self):
+        return (self._sorted.buffer_info()[1] * self._sorted.itemsize
+                + (len(self._pending) + len(self._merging)) * 72)
+
+# Фильтр Блума: около 1.8 МБ на миллион id при доле ложных срабатываний 0.1%.
+# Положительный ответ означает "возможно", поэтому подтверждается запросом к базе.
+class IssuedBloomFilter:
+    definitive = False
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.size = max(64, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, value: int):
+        value &= 0xFFFFFFFFFFFFFFFF
+        h1 = (value * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = (((value ^ (value >> 31)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self, value: int):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value: int):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def extend_sorted(self, values):
+        for value in values:
+            self.add(value)
+
+    def memory_bytes(self):
+        return len(self._bits)
+
+statements.register('issued_user_ids', "SELECT user_id AS id FROM used_codes ORDER BY user_id", hot=False)
+statements.register(
+    'issued_chat_ids',
+    "SELECT DISTINCT ip_address::bigint AS id FROM used_codes WHERE ip_address ~ '^-?[0-9]+$' ORDER BY 1",
+    hot=False,
+)
+
+# Кто уже получил код: id пользователей и id чатов (chat.id хранится в used_codes.ip_address).
+# Заполняется при старте потоковым чтением used_codes и пополняется при каждой выдаче.
+class IssuedFilter:
+    def __init__(self, mode: str, capacity: int, fp_rate: float):
+        self.mode = mode
+        if mode == 'bloom':
+            self.users = IssuedBloomFilter(capacity, fp_rate)
+            self.chats = IssuedBloomFilter(capacity, fp_rate)
+        else:
+            self.users = IssuedIdSet()
+            self.chats = IssuedIdSet()
+        self.definitive = self.users.definitive
+        self.hits = 0
+        self.misses = 0
+
+    # Возвращает (чат уже использован, пользователь уже получил код)
+    def lookup(self, user_id: int, chat_id: int):
+        chat_seen = int(chat_id) in self.chats
+        user_seen = user_id in self.users
+        if chat_seen or user_seen:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return chat_seen, user_seen
+
+    def add_user(self, user_id: int):
+        self.users.add(user_id)
+
+    def add_chat(self, chat_id: int):
+        self.chats.add(int(chat_id))
+
+    async def warm(self):
+        await self._load(self.users, 'issued_user_ids')
+        await self._load(self.chats, 'issued_chat_ids')
+        logger.info("Фильтр выданных кодов загружен: %s пользователей, %s чатов", len(self.users), len(self.chats))
+
+    async def _load(self, target, name: str):
+        batch = []
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                async for row in statements.cursor(conn, name, prefetch=10000):
+                    batch.append(row['id'])
+                    if len(batch) >= 10000:
+                        target.extend_sorted(batch)
+                        batch = []
+        target.extend_sorted(batch)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "users": len(self.users),
+            "chats": len(self.chats),
+            "memory_bytes": self.users.memory_bytes() + self.chats.memory_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+issued_filter = None
+if ISSUED_FILTER_MODE != 'off':
+    issued_filter = IssuedFilter(ISSUED_FILTER_MODE, ISSUED_FILTER_CAPACITY, ISSUED_FILTER_FP_RATE)
+
+# Постраничный просмотр кодов по ключу (code), без OFFSET и без загрузки всей таблицы
+statements.register(
+    'codes_page_before', "SELECT code, site_url FROM codes WHERE code < $1 ORDER BY code DESC LIMIT $2", hot=False,
+)
+statements.register(
+    'codes_page_after',
+    "SELECT code, site_url FROM codes WHERE $1::text IS NULL OR code > $1 ORDER BY code LIMIT $2",
+    hot=False,
+)
+
+async def fetch_codes_page(after: str = None, before: str = None, limit: int = CODES_PAGE_SIZE):
+    async with get_db_connection() as conn:
+        if before is not None:
+            rows = await statements.fetch(conn, 'codes_page_before', before, limit + 1)
+            has_prev = len(rows) > limit
+            return list(reversed(rows[:limit])), has_prev, True
+        rows = await statements.fetch(conn, 'codes_page_after', after, limit + 1)
+        return rows[:limit], after is not None, len(rows) > limit
+
+# Количество кодов по статистике планировщика; точный подсчет только для небольших таблиц
+CODES_EXACT_COUNT_LIMIT = 10000
+statements.register(
+    'estimate_codes', "SELECT reltuples::bigint FROM pg_class WHERE oid = 'codes'::regclass", hot=False,
+)
+statements.register('count_codes', "SELECT count(*) FROM codes", hot=False)
+
+async def count_codes():
+    async with get_db_connection() as conn:
+        estimate = await statements.fetchval(conn, 'estimate_codes')
+        if estimate is None or estimate < CODES_EXACT_COUNT_LIMIT:
+            return await statements.fetchval(conn, 'count_codes'), True
+    return estimate, False
+
+# Выгрузка всех кодов в CSV через серверный курсор, строки не накапливаются в памяти
+statements.register('export_codes', "SELECT code, site_url FROM codes ORDER BY code", hot=False)
+
+async def export_codes(file):
+    writer = csv.writer(file)
+    writer.writerow(['code', 'site_url'])
+    exported = 0
+    async with get_db_connection() as conn:
+        async with conn.transaction():
+            async for row in statements.cursor(conn, 'export_codes', prefetch=1000):
+                writer.writerow([row['code'], row['site_url']])
+                exported += 1
+    return exported
+
+# Выдача кода: из резерва в памяти, если он включен, иначе напрямую из базы
+@traced('claim')
+async def issue_code(user_id: int, ip_address: str):
+    if code_reservoir is not None:
+        return await code_reservoir.claim(user_id, ip_address)
+    return await claim_code(user_id, ip_address)
+
+# Кэш с временем жизни записей и ограничением размера (вытесняются давно не использованные)
+class TTLCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl: float):
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE)
+
+# Количество, среднее и максимум длительностей
+class LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+# Метрики в текстовом формате Prometheus. Запись — поиск по словарю и увеличение
+# счетчиков без блокировок (все вызовы идут из одного цикла событий), текст собирается
+# только при запросе /metrics.
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+# Гистограмма с одной меткой: для каждого значения метки — счетчики по корзинам,
+# сумма и количество наблюдений
+class Histogram:
+    def __init__(self, name: str, help: str, label: str, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.children = {}
+
+    def observe(self, value: str, seconds: float):
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = [[0] * (len(self.buckets) + 1), 0.0]
+        child[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        child[1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, (counts, total) in sorted(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(((self.label, value), ('le', le)))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(((self.label, value),))} {total}")
+            lines.append(f"{self.name}_count{format_labels(((self.label, value),))} {cumulative}")
+        return lines
+
+# Счетчик, необязательно с одной меткой
+class Counter:
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, value: str = None, amount: float = 1):
+        self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        if not self.values and self.label is None:
+            lines.append(f"{self.name} 0")
+        for value, total in sorted(self.values.items(), key=lambda item: str(item[0])):
+            labels = ((self.label, value),) if self.label is not None else ()
+            lines.append(f"{self.name}{format_labels(labels)} {total}")
+        return lines
+
+# Значение, которое вычисляется при запросе /metrics (размеры пула и очередей,
+# счетчики, которые уже ведут другие объекты). collect возвращает число или
+# словарь {значение метки: число}.
+class Collected:
+    def __init__(self, name: str, kind: str, help: str, collect, label: str = None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.collect = collect
+        self.label = label
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        result = self.collect()
+        if isinstance(result, dict):
+            for value, number in result.items():
+                lines.append(f"{self.name}{format_labels(((self.label, value),))} {number}")
+        else:
+            lines.append(f"{self.name} {result}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.register(Histogram('bot_handler_seconds', 'Handler duration', 'handler'))
+db_query_seconds = metrics.register(Histogram('bot_db_query_seconds', 'SQL statement duration', 'statement'))
+bot_api_seconds = metrics.register(Histogram('bot_api_request_seconds', 'Bot API request duration', 'method'))
+codes_issued = metrics.register(Counter('bot_codes_issued_total', 'Codes issued'))
+codes_sold_out = metrics.register(Counter('bot_codes_sold_out_total', 'Code requests answered with sold out'))
+code_rejections = metrics.register(Counter('bot_code_rejections_total', 'Code requests rejected', 'reason'))
+errors = metrics.register(Counter('bot_errors_total', 'Errors while handling updates', 'stage'))
+
+# Корзина токенов: запас до capacity, пополняется со скоростью rate токенов в секунду
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now: float):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # Возврат токена, если запрос все же не выполнен
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    # Сколько секунд ждать до следующего токена
+    def delay(self, now: float):
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+# Настройка ограничения частоты для обработчика; обработчики без нее не ограничиваются.
+# rate/burst — корзина каждого пользователя, global_rate/global_burst — общая корзина
+# обработчика (не заданы — значения по умолчанию из ThrottlingMiddleware)
+def rate_limit(key: str, rate: float, burst: int, global_rate: float = None, global_burst: int = None):
+    def decorator(handler):
+        handler.throttling_key = key
+        handler.throttling_rate = rate
+        handler.throttling_burst = burst
+        handler.throttling_global_rate = global_rate
+        handler.throttling_global_burst = global_burst
+        return handler
+    return decorator
+
+# Ограничение частоты: корзина токенов на пользователя и общая корзина на обработчик.
+# Корзины пользователей хранятся в порядке последнего обращения, простаивающие дольше
+# idle_ttl удаляются с начала очереди, поэтому проверка стоит O(1). Об ограничении
+# пользователь узнает не чаще одного раза за cooldown; ограниченные нажатия кнопок
+# все равно получают пустой ответ на callback.
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, global_rate: float, global_burst: int, idle_ttl: float, cooldown: float):
+        super().__init__()
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.idle_ttl = idle_ttl
+        self.cooldown = cooldown
+        self._user_buckets = {}
+        self._global_buckets = {}
+        self._notified = TTLCache(100000)
+        self.throttled = 0
+
+    def _allow(self, handler, user_id: int):
+        now = time.monotonic()
+        key = handler.throttling_key
+        buckets = self._user_buckets.setdefault(key, OrderedDict())
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            if now - oldest.updated < self.idle_ttl:
+                break
+            buckets.popitem(last=False)
+
+        bucket = buckets.pop(user_id, None)
+        if bucket is None:
+            bucket = TokenBucket(handler.throttling_rate, handler.throttling_burst, now)
+        buckets[user_id] = bucket
+        if not bucket.consume(now):
+            return False
+
+        global_bucket = self._global_buckets.get(key)
+        if global_bucket is None:
+            global_bucket = self._global_buckets[key] = TokenBucket(
+                handler.throttling_global_rate or self.global_rate,
+                handler.throttling_global_burst or self.global_burst,
+                now,
+            )
+        if global_bucket.consume(now):
+            return True
+        # Отказ общей корзины не расходует лимит пользователя
+        bucket.refund()
+        return False
+
+    def _check(self, user_id: int, handler=None):
+        handler = handler or current_handler.get()
+        if handler is None or not hasattr(handler, 'throttling_key') or user_id in ADMIN_IDS:
+            return True, False
+        if self._allow(handler, user_id):
+            return True, False
+        self.throttled += 1
+        notify = self._notified.get(user_id) is None
+        if notify:
+            self._notified.set(user_id, True, self.cooldown)
+        return False, notify
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        allowed, notify = self._check(message.from_user.id)
+        if allowed:
+            return
+        if notify:
+            submit_reply(message, "Слишком много запросов. Пожалуйста, подождите немного.")
+        raise CancelHandler()
+
+    # Проверка нажатия кнопки; handler задается, если проверка идет вне обработки
+    # обновления (в вебхуке). Ограниченное нажатие сразу получает ответ: без
+    # answerCallbackQuery у клиента крутится индикатор; текст только в первом ответе за cooldown
+    def allow_callback(self, callback_query: types.CallbackQuery, handler=None):
+        allowed, notify = self._check(callback_query.from_user.id, handler)
+        if allowed:
+            return True
+        answer = outbox.submit(
+            'answer_callback_query', PRIORITY_ACK, callback_query_id=callback_query.id,
+            text="Слишком много запросов. Пожалуйста, подождите немного." if notify else None,
         )
-    ''')
-    await conn.execute(''' 
-        CREATE TABLE IF NOT EXISTS used_codes (
-            user_id BIGINT PRIMARY KEY,  -- Заменили INTEGER на BIGINT
-            code TEXT,
-            ip_address TEXT
+        answer.add_done_callback(log_send_error)
+        return False
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        if callback_acknowledged.get():
+            return  # Проверено в вебхуке
+        if not self.allow_callback(callback_query):
+            raise CancelHandler()
+
+    def stats(self):
+        return {
+            "throttled": self.throttled,
+            "tracked_users": sum(len(buckets) for buckets in self._user_buckets.values()),
+        }
+
+# Файл для загрузки через планировщик. aiohttp закрывает InputFile после отправки, поэтому
+# для каждой попытки (в том числе повтора после RetryAfter) файл открывается заново
+class Upload:
+    def __init__(self, path: str, filename: str):
+        self.path = path
+        self.filename = filename
+
+    def open(self):
+        return types.InputFile(self.path, filename=self.filename)
+
+# Приоритеты исходящих запросов: меньше — раньше
+PRIORITY_ACK = 0  # Ответы на нажатия кнопок
+PRIORITY_CODE = 1  # Сообщения с выданным кодом
+PRIORITY_INFO = 2  # Остальные сообщения
+
+# Время получения текущего обновления вебхуком (time.monotonic())
+update_received_at = ContextVar('update_received_at', default=None)
+
+# Ответ вебхука, ожидающий первый запрос к Bot API текущего обновления (если режим включен)
+webhook_response = ContextVar('webhook_response', default=None)
+
+# Нажатие get_code уже проверено ограничением частоты и подтверждено в вебхуке
+callback_acknowledged = ContextVar('callback_acknowledged', default=False)
+
+# Запросы, которые можно вернуть в ответе вебхука: их результат обработчикам не нужен
+WEBHOOK_REPLY_METHODS = {'send_message', 'edit_message_text', 'answer_callback_query'}
+
+def to_webhook_reply(method: str, params: dict):
+    name, *rest = method.split('_')
+    payload = {key: prepare_arg(value) for key, value in params.items() if value is not None}
+    payload['method'] = name + ''.join(part.capitalize() for part in rest)
+    return payload
+
+# Планировщик исходящих запросов к Bot API. Все отправки проходят через очередь
+# с приоритетами; сообщения ограничиваются общей корзиной токенов и корзиной на чат.
+# Сообщение в чат, исчерпавший лимит, откладывается, не задерживая другие чаты.
+# При RetryAfter запрос повторяется через указанное Telegram время.
+class OutboundScheduler:
+    CHAT_IDLE_TTL = 60
+
+    def __init__(self, global_rate: float, global_burst: int, chat_rate: float, chat_burst: int,
+                 workers: int, max_retries: int, direct_workers: int = 0):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.direct_workers = direct_workers or workers
+        self.max_retries = max_retries
+        self.queue = asyncio.PriorityQueue()
+        # Запросы без chat_id лимитам не подчиняются и идут отдельной очередью со своими
+        # воркерами: их не задерживают воркеры, ждущие токенов для сообщений
+        self.direct_queue = asyncio.PriorityQueue()
+        self._global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        self._chat_buckets = OrderedDict()
+        self._gate = asyncio.Lock()
+        self._in_flight = {}  # future -> Event, выставляется по завершении отправки
+        self._seq = 0
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.webhook_replies = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # Лимит на чат применяется к запросам с chat_id (отправка и изменение сообщений).
+    # webhook_reply=False — обработчику нужен результат запроса, в ответ вебхука его не отдаем.
+    # submit() ставит запрос в очередь сразу и возвращает future, call() ждет результат
+    def submit(self, method: str, priority: int = PRIORITY_INFO, webhook_reply: bool = True, **params):
+        future = asyncio.get_running_loop().create_future()
+        chat_id = params.get('chat_id')
+        if webhook_reply and self._reply_in_webhook(method, chat_id, params):
+            future.set_result(None)
+            return future
+        self._seq += 1
+        self._queue_for(chat_id).put_nowait(
+            (priority, self._seq, method, chat_id, params, future, time.monotonic(), 0, current_trace.get())
         )
-    ''')
-    await conn.execute(''' 
-        CREATE INDEX IF NOT EXISTS idx_used_codes_user_id ON used_codes (user_id);
-    ''')
-    await conn.execute(''' 
-        CREATE INDEX IF NOT EXISTS idx_codes_code ON codes (code);
-    ''')
-    await conn.close()
-
-# Функция для получения уникального кода
-async def get_unique_code():
-    conn = await get_db_connection()
-    result = await conn.fetchrow("SELECT code, site_url FROM codes LIMIT 1")  # Получаем первый доступный код и сайт
-    if result:
-        await conn.execute("DELETE FROM codes WHERE code = $1", result['code'])  # Удаляем код из базы после выдачи
-    await conn.close()
-    return result
+        return future
+
+    def _queue_for(self, chat_id):
+        return self.queue if chat_id is not None else self.direct_queue
+
+    async def call(self, method: str, priority: int = PRIORITY_INFO, webhook_reply: bool = True, **params):
+        return await self.submit(method, priority, webhook_reply, **params)
+
+    # Отзыв запроса: ожидающий в очереди отменяется, а если он уже отправляется,
+    # дожидаемся ответа, чтобы следующий запрос к тому же сообщению пришел после него
+    async def withdraw(self, future):
+        sending = self._in_flight.get(future)
+        if sending is not None:
+            await sending.wait()
+        future.cancel()
+
+    def _reply_in_webhook(self, method: str, chat_id, params: dict):
+        response = webhook_response.get()
+        if response is None or response.done() or method not in WEBHOOK_REPLY_METHODS:
+            return False
+        if chat_id is not None:
+            now = time.monotonic()
+            # Ответ вебхука тоже считается в лимитах; ждать его нельзя, поэтому при
+            # исчерпанном лимите запрос идет обычным путем через очередь
+            if self._chat_bucket(chat_id, now).delay(now) > 0 or not self._global_bucket.consume(now):
+                return False
+            self._chat_bucket(chat_id, now).consume(now)
+        response.set_result(to_webhook_reply(method, params))
+        self.webhook_replies += 1
+        return True
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker(self.queue)) for _ in range(self.workers)]
+        self._tasks += [asyncio.create_task(self._worker(self.direct_queue)) for _ in range(self.direct_workers)]
+
+    async def stop(self, timeout: float):
+        try:
+            await asyncio.wait_for(asyncio.gather(self.queue.join(), self.direct_queue.join()), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не отправлено сообщений при остановке: %s", self.queue.qsize() + self.direct_queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _chat_bucket(self, chat_id, now: float):
+        while self._chat_buckets:
+            oldest = next(iter(self._chat_buckets.values()))
+            if now - oldest.updated < self.CHAT_IDLE_TTL:
+                break
+            self._chat_buckets.popitem(last=False)
+        bucket = self._chat_buckets.pop(chat_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+        self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    # Токены берет один обработчик за раз: иначе все, кто дождался общего токена,
+    # отправили бы одновременно. Возвращает 0, если оба токена получены, иначе сколько
+    # ждать лимита чата (общий токен тогда не расходуется)
+    async def _acquire(self, chat_id) -> float:
+        async with self._gate:
+            while True:
+                now = time.monotonic()
+                chat_bucket = self._chat_bucket(chat_id, now)
+                wait = chat_bucket.delay(now)
+                if wait > 0:
+                    return wait
+                if self._global_bucket.consume(now):
+                    chat_bucket.consume(now)
+                    return 0.0
+                await asyncio.sleep(self._global_bucket.delay(now))
+
+    # Отложенный запрос остается незавершенным для join(), пока снова не попадет в очередь
+    def _requeue(self, item):
+        queue = self._queue_for(item[3])
+        queue.put_nowait(item)
+        queue.task_done()
+
+    async def _worker(self, queue: asyncio.PriorityQueue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            priority, seq, method, chat_id, params, future, enqueued_at, attempt, trace = item
+            if future.done():
+                queue.task_done()
+                continue
+            if chat_id is not None:
+                wait = await self._acquire(chat_id)
+                if wait > 0:
+                    # Чат исчерпал лимит: возвращаем сообщение в очередь позже
+                    loop.call_later(wait, self._requeue, item)
+                    continue
+                if future.done():  # Отменен, пока ждал лимита
+                    queue.task_done()
+                    continue
+
+            if attempt == 0:
+                latency = time.monotonic() - enqueued_at
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            # Запрос попадает в трассу обновления, которое его отправило
+            trace_token = current_trace.set(trace)
+            sending = self._in_flight[future] = asyncio.Event()
+            try:
+                result = await getattr(bot, method)(**{
+                    key: value.open() if isinstance(value, Upload) else value for key, value in params.items()
+                })
+            except RetryAfter as e:
+                self.retry_after += 1
+                if attempt < self.max_retries:
+                    logger.warning("RetryAfter для %s, повтор через %s с", method, e.timeout)
+                    retry = (priority, seq, method, chat_id, params, future, enqueued_at, attempt + 1, trace)
+                    loop.call_later(e.timeout, self._requeue, retry)
+                    continue
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                if not future.done():  # Отправитель мог отменить запрос, пока тот выполнялся
+                    future.set_result(result)
+            finally:
+                del self._in_flight[future]
+                sending.set()
+                current_trace.reset(trace_token)
+            queue.task_done()
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize() + self.direct_queue.qsize(),
+            "direct_depth": self.direct_queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "webhook_replies": self.webhook_replies,
+            "latency_avg_ms": round(self.latency_total / self.sent * 1000, 3) if self.sent else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 3),
+        }
+
+outbox = OutboundScheduler(
+    OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_WORKERS, OUTBOX_MAX_RETRIES,
+    OUTBOX_DIRECT_WORKERS,
+)
+
+# Отправка ответов через планировщик
+async def reply(message: types.Message, text: str, priority: int = PRIORITY_INFO, **kwargs):
+    return await outbox.call(
+        'send_message', priority,
+        chat_id=message.chat.id, text=text, reply_to_message_id=message.message_id, **kwargs
+    )
+
+async def reply_document(message: types.Message, document, priority: int = PRIORITY_INFO, **kwargs):
+    return await outbox.call(
+        'send_document', priority,
+        chat_id=message.chat.id, document=document, reply_to_message_id=message.message_id, **kwargs
+    )
+
+async def edit_text(message: types.Message, text: str, priority: int = PRIORITY_INFO, **kwargs):
+    try:
+        return await outbox.call(
+            'edit_message_text', priority,
+            chat_id=message.chat.id, message_id=message.message_id, text=text, **kwargs
+        )
+    except MessageNotModified:
+        return None
+
+# Для запросов, результат которых не ждут
+def log_send_error(future: asyncio.Future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None and not isinstance(error, MessageNotModified):
+        logger.error("Ошибка при отправке запроса к Bot API: %s", error)
+
+# Отправка без ожидания результата: воркер обновлений не простаивает, пока сообщение
+# ждет лимитов исходящих запросов. Ошибки только логируются
+def submit_reply(message: types.Message, text: str, priority: int = PRIORITY_INFO, **kwargs):
+    future = outbox.submit(
+        'send_message', priority,
+        chat_id=message.chat.id, text=text, reply_to_message_id=message.message_id, **kwargs
+    )
+    future.add_done_callback(log_send_error)
+    return future
+
+def submit_edit(message: types.Message, text: str, priority: int = PRIORITY_INFO, **kwargs):
+    future = outbox.submit(
+        'edit_message_text', priority,
+        chat_id=message.chat.id, message_id=message.message_id, text=text, **kwargs
+    )
+    future.add_done_callback(log_send_error)
+    return future
+
+async def answer_callback(callback_query: types.CallbackQuery, text: str = None, **kwargs):
+    return await outbox.call(
+        'answer_callback_query', PRIORITY_ACK,
+        callback_query_id=callback_query.id, text=text, **kwargs
+    )
+
+throttling = ThrottlingMiddleware(THROTTLE_GLOBAL_RATE, THROTTLE_GLOBAL_BURST, THROTTLE_IDLE_TTL, THROTTLE_COOLDOWN)
+dp.middleware.setup(throttling)
+
+# Время работы обработчиков по имени функции. Начало и имя сохраняются в data на этапе
+# process (после фильтров и троттлинга), итог пишется в post_process.
+class MetricsMiddleware(BaseMiddleware):
+    def _start(self, data: dict):
+        data['metrics_handler'] = (current_handler.get().__name__, time.perf_counter())
+
+    def _finish(self, data: dict):
+        started = data.get('metrics_handler')
+        if started is not None:
+            handler_seconds.observe(started[0], time.perf_counter() - started[1])
+            record_span('handler:' + started[0], started[1])
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finish(data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._finish(data)
+
+    async def on_process_chat_member(self, update: types.ChatMemberUpdated, data: dict):
+        self._start(data)
+
+    async def on_post_process_chat_member(self, update: types.ChatMemberUpdated, results, data: dict):
+        self._finish(data)
+
+dp.middleware.setup(MetricsMiddleware())
+
+MEMBER_STATUSES = ['member', 'administrator', 'creator']
+
+# Фоновые задачи, результат которых не ждут; ссылки хранятся, чтобы задачи не собрал GC
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Объединение одновременных запросов с одним ключом: пока задача для ключа выполняется,
+# повторные вызовы ждут ее результат, а не запускают новую. Запись удаляется сразу
+# по завершении задачи.
+class SingleFlight:
+    def __init__(self):
+        self._in_flight = {}
+        self.coalesced = 0
+
+    async def run(self, key, coro_factory):
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        task = asyncio.create_task(coro_factory())
+        self._in_flight[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    def stats(self):
+        return {"in_flight": len(self._in_flight), "coalesced": self.coalesced}
+
+# Подписчики канала по событиям chat_member: таблица channel_members и ее копия в памяти.
+# Более старые события не перезаписывают более новые. Изменения, записанные другими
+# репликами, подтягиваются из базы по recorded_at каждые CHANNEL_MEMBERS_SYNC_INTERVAL.
+statements.register('upsert_channel_member', '''
+    INSERT INTO channel_members (user_id, is_member, status, changed_at)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (user_id) DO UPDATE
+        SET is_member = EXCLUDED.is_member, status = EXCLUDED.status,
+            changed_at = EXCLUDED.changed_at, recorded_at = now()
+        WHERE channel_members.changed_at <= EXCLUDED.changed_at
+    RETURNING is_member
+''')
+statements.register('load_channel_members', "SELECT user_id, is_member, recorded_at FROM channel_members", hot=False)
+# Небольшое перекрытие окна, чтобы не пропустить поздно закоммиченные записи
+statements.register('sync_channel_members', '''
+    SELECT user_id, is_member, recorded_at FROM channel_members
+    WHERE $1::timestamptz IS NULL OR recorded_at > $1::timestamptz - interval '1 second'
+''', hot=False)
+
+class ChannelMembers:
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        self._members = {}
+        self._synced_until = None
+        self._task = None
+        self.events = 0
+
+    def get(self, user_id: int):
+        return self._members.get(user_id)
+
+    async def load(self):
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                async for row in statements.cursor(conn, 'load_channel_members', prefetch=10000):
+                    self._apply(row)
+        logger.info("Загружено подписчиков канала: %s", len(self._members))
+
+    def _apply(self, row):
+        self._members[row['user_id']] = row['is_member']
+        if self._synced_until is None or row['recorded_at'] > self._synced_until:
+            self._synced_until = row['recorded_at']
+
+    async def update(self, user_id: int, status: str, changed_at):
+        is_member = status in MEMBER_STATUSES
+        async with get_db_connection() as conn:
+            stored = await statements.fetchval(conn, 'upsert_channel_member', user_id, is_member, status, changed_at)
+        if stored is not None:
+            self._members[user_id] = stored
+            subscription_cache.pop(user_id)
+        self.events += 1
+
+    async def start(self):
+        await self.load()
+        self._task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                async with get_db_connection() as conn:
+                    rows = await statements.fetch(conn, 'sync_channel_members', self._synced_until)
+                for row in rows:
+                    self._apply(row)
+            except Exception:
+                logger.exception("Ошибка при синхронизации подписчиков канала")
+
+    def stats(self):
+        return {"known": len(self._members), "members": sum(self._members.values()), "events": self.events}
+
+channel_members = ChannelMembers(CHANNEL_MEMBERS_SYNC_INTERVAL)
+
+def is_channel(chat: types.Chat):
+    if str(chat.id) == CHANNEL_ID:
+        return True
+    return bool(chat.username) and CHANNEL_ID.lower() == '@' + chat.username.lower()
+
+async def get_channel_status(user_id: int):
+    member = await bot.get_chat_member(CHANNEL_ID, user_id)
+    # Логируем статус пользователя
+    update_log.debug("User %s status in channel: %s", user_id, member.status)
+    return member.status in MEMBER_STATUSES
 
 # Проверка подписки на канал
+@traced('subscription')
 async def check_subscription(user_id: int):
+    # Пользователи, о которых бот знает по событиям канала, проверяются без запросов к API
+    is_subscribed = channel_members.get(user_id)
+    if is_subscribed is not None:
+        return is_subscribed
+    is_subscribed = subscription_cache.get(user_id)
+    if is_subscribed is not None:
+        return is_subscribed
     try:
-        # Задержка перед проверкой подписки (2 секунды)
-        await asyncio.sleep(2)
-        
-        member = await bot.get_chat_member(CHANNEL_ID, user_id)
-        # Логируем статус пользователя
-        logger.debug(f"User {user_id} status in channel: {member.status}")
-        
-        if member.status in ['member', 'administrator', 'creator']:
-            return True
-        return False
+        # Пользователь мог подписаться только что: вместо фиксированной задержки
+        # повторяем проверку с растущей паузой, но только при отрицательном ответе
+        delay = SUBSCRIPTION_RETRY_DELAY
+        for attempt in range(SUBSCRIPTION_RETRIES + 1):
+            is_subscribed = await get_channel_status(user_id)
+            if is_subscribed or attempt == SUBSCRIPTION_RETRIES:
+                break
+            await asyncio.sleep(delay)
+            delay *= 2
+
+        ttl = SUBSCRIPTION_POSITIVE_TTL if is_subscribed else SUBSCRIPTION_NEGATIVE_TTL
+        subscription_cache.set(user_id, is_subscribed, ttl)
+        if is_subscribed:
+            # Подписку, подтвержденную API, запоминаем; об отписке сообщит событие chat_member
+            run_in_background(channel_members.update(user_id, 'member', datetime.now(timezone.utc)))
+        return is_subscribed
     except ChatNotFound:
-        logger.error(f"Channel not found or user {user_id} is not a member of the channel")
+        logger.error("Channel not found or user %s is not a member of the channel", user_id)
         return False
     except Exception as e:
-        logger.error(f"Error checking subscription for user {user_id}: {str(e)}")
+        logger.error("Error checking subscription for user %s: %s", user_id, e)
         return False
 
-# Проверка, был ли использован IP-адрес
-async def check_ip(ip_address: str):
-    conn = await get_db_connection()
+# Проверка права на получение кода одним запросом: использован ли IP-адрес (chat.id)
+# и получал ли пользователь код. Оба условия проверяются по индексам.
+statements.register('check_eligibility', '''
+    SELECT EXISTS (SELECT 1 FROM used_codes WHERE ip_address = $2) AS ip_used,
+           EXISTS (SELECT 1 FROM used_codes WHERE user_id = $1) AS code_given
+''')
+
+@traced('eligibility')
+async def check_eligibility(user_id: int, ip_address: str):
     ip_address = str(ip_address)  # Преобразуем IP-адрес в строку
-    exists = await conn.fetchval("SELECT 1 FROM used_codes WHERE ip_address = $1", ip_address)
-    await conn.close()
-    return exists is not None
+    async with get_db_connection() as conn:
+        result = await statements.fetchrow(conn, 'check_eligibility', user_id, ip_address)
+    return result['ip_used'], result['code_given']
 
-# Проверка, был ли выдан код этому пользователю
-async def check_code_given(user_id: int):
-    conn = await get_db_connection()
-    exists = await conn.fetchval("SELECT 1 FROM used_codes WHERE user_id = $1", user_id)
-    await conn.close()
-    return exists is not None
+# Запросы администратора выполняются редко и заранее не подготавливаются
+statements.register('insert_code', "INSERT INTO codes (code, site_url) VALUES ($1, $2)", hot=False)
+statements.register('delete_code', "DELETE FROM codes WHERE code = $1", hot=False)
 
 # Команды для администратора
 @dp.message_handler(commands=["add_code"], user_id=ADMIN_IDS)
 async def add_code(message: types.Message):
-    logger.debug(f"Received add_code command from admin {message.from_user.id}")
+    logger.debug("Received add_code command from admin %s", message.from_user.id)
     
     # Получение кода и URL сайта от администратора
     parts = message.text.split(" ", 2)
     if len(parts) < 3:
-        await message.reply("Использование: /add_code <код> <сайт>")
+        await reply(
+            message,
+            "Использование: /add_code <код> <сайт>\n"
+            "Для массовой загрузки отправьте CSV/TXT файл со строками \"код,сайт\"."
+        )
         return
     
     code, site_url = parts[1], parts[2]
     
-    conn = await get_db_connection()
-    await conn.execute("INSERT INTO codes (code, site_url) VALUES ($1, $2)", code, site_url)
-    await conn.close()
+    async with get_db_connection() as conn:
+        await statements.execute(conn, 'insert_code', code, site_url)
     
-    await message.reply(f"Код {code} успешно добавлен!")
+    await reply(message, f"Код {code} успешно добавлен!")
 
-@dp.message_handler(commands=["show_codes"], user_id=ADMIN_IDS)
-async def show_codes(message: types.Message):
-    logger.debug(f"Received show_codes command from admin {message.from_user.id}")
-    
-    conn = await get_db_connection()
-    codes = await conn.fetch("SELECT * FROM codes")
-    await conn.close()
+# Длинные значения обрезаются, чтобы страница помещалась в лимит сообщения Telegram
+def shorten(value: str, limit: int = 60):
+    value = str(value)
+    return value if len(value) <= limit else value[:limit - 1] + "…"
+
+# Позиция страницы (номер и граничные коды) хранится в состоянии администратора по
+# message_id сообщения со списком: кнопки каждого сообщения листают от его собственной
+# страницы. Хранятся позиции последних CODES_CURSORS_KEPT сообщений; после перезапуска
+# (MemoryStorage пуст) позиции нет, и администратор получает просьбу открыть список заново.
+CODES_CURSORS_KEPT = 20
+
+async def save_codes_cursor(state: FSMContext, message_id: int, cursor: dict):
+    cursors = dict((await state.get_data()).get('codes_cursors', {}))
+    cursors.pop(str(message_id), None)
+    cursors[str(message_id)] = cursor
+    while len(cursors) > CODES_CURSORS_KEPT:
+        cursors.pop(next(iter(cursors)))
+    await state.update_data(codes_cursors=cursors)
 
+async def render_codes_page(page: int, after: str = None, before: str = None):
+    codes, has_prev, has_next = await fetch_codes_page(after=after, before=before)
     if not codes:
-        await message.reply("Нет доступных кодов.")
+        return None, None, None
+    total, exact = await count_codes()
+    cursor = {"page": page, "first": codes[0]['code'], "last": codes[-1]['code']}
+
+    code_list = "\n".join([f"Код: {shorten(code['code'])} - Сайт: {shorten(code['site_url'])}" for code in codes])
+    text = f"Список кодов (всего {'' if exact else '≈'}{total}, стр. {page}):\n{code_list}"
+
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data="codes:prev"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперед ➡️", callback_data="codes:next"))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.add(InlineKeyboardButton("📄 Выгрузить все", callback_data="codes:export"))
+    return text, keyboard, cursor
+
+@dp.message_handler(commands=["show_codes"], user_id=ADMIN_IDS)
+async def show_codes(message: types.Message, state: FSMContext):
+    logger.debug("Received show_codes command from admin %s", message.from_user.id)
+
+    text, keyboard, cursor = await render_codes_page(page=1)
+    if text is None:
+        await reply(message, "Нет доступных кодов.")
+        return
+    # Нужен message_id отправленного сообщения, поэтому не в ответе вебхука
+    sent = await outbox.call(
+        'send_message', PRIORITY_INFO, webhook_reply=False,
+        chat_id=message.chat.id, text=text, reply_to_message_id=message.message_id, reply_markup=keyboard,
+    )
+    await save_codes_cursor(state, sent.message_id, cursor)
+
+@dp.callback_query_handler(text=["codes:prev", "codes:next"], user_id=ADMIN_IDS)
+async def show_codes_page(callback_query: types.CallbackQuery, state: FSMContext):
+    message = callback_query.message
+    cursor = (await state.get_data()).get('codes_cursors', {}).get(str(message.message_id))
+    if cursor is None:
+        await answer_callback(callback_query, "Список устарел. Отправьте /show_codes заново.", show_alert=True)
         return
 
-    code_list = "\n".join([f"Код: {code['code']} - Сайт: {code['site_url']}" for code in codes])
-    await message.reply(f"Список кодов:\n{code_list}")
+    if callback_query.data == "codes:next":
+        text, keyboard, cursor = await render_codes_page(cursor["page"] + 1, after=cursor["last"])
+    else:
+        text, keyboard, cursor = await render_codes_page(max(cursor["page"] - 1, 1), before=cursor["first"])
+
+    await answer_callback(callback_query)
+    if text is None:
+        await edit_text(message, "Нет доступных кодов.")
+        return
+    await save_codes_cursor(state, message.message_id, cursor)
+    await edit_text(message, text, reply_markup=keyboard)
+
+@dp.callback_query_handler(text="codes:export", user_id=ADMIN_IDS)
+async def export_codes_file(callback_query: types.CallbackQuery):
+    logger.debug("Received codes export request from admin %s", callback_query.from_user.id)
+    await answer_callback(callback_query, "⏳ Готовлю файл...")
+
+    # Файл на диске, а не в памяти: при повторе после RetryAfter он открывается заново
+    text_file = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.csv', delete=False)
+    try:
+        with text_file:
+            exported = await export_codes(text_file)
+        await reply_document(
+            callback_query.message,
+            Upload(text_file.name, "codes.csv"),
+            caption=f"Выгружено кодов: {exported}",
+        )
+    except Exception as e:
+        logger.error("Ошибка при выгрузке кодов для администратора %s: %s", callback_query.from_user.id, e)
+        errors.inc('export')
+        await reply(callback_query.message, f"Не удалось выгрузить коды: {e}")
+    finally:
+        os.remove(text_file.name)
 
 @dp.message_handler(commands=["delete_code"], user_id=ADMIN_IDS)
 async def delete_code(message: types.Message):
-    logger.debug(f"Received delete_code command from admin {message.from_user.id}")
+    logger.debug("Received delete_code command from admin %s", message.from_user.id)
     
     parts = message.text.split(" ", 1)
     if len(parts) < 2:
-        await message.reply("Использование: /delete_code <код>")
+        await reply(message, "Использование: /delete_code <код>")
         return
     
     code = parts[1]
     
-    conn = await get_db_connection()
-    result = await conn.execute("DELETE FROM codes WHERE code = $1", code)
-    await conn.close()
+    async with get_db_connection() as conn:
+        result = await statements.execute(conn, 'delete_code', code)
     
     if result == "DELETE 0":
-        await message.reply(f"Код {code} не найден.")
+        await reply(message, f"Код {code} не найден.")
     else:
-        await message.reply(f"Код {code} успешно удален!")
+        await reply(message, f"Код {code} успешно удален!")
+
+@dp.message_handler(content_types=types.ContentType.DOCUMENT, user_id=ADMIN_IDS)
+async def import_codes_file(message: types.Message):
+    document = message.document
+    logger.debug("Received codes file %s from admin %s", document.file_name, message.from_user.id)
+
+    if not (document.file_name or '').lower().endswith(('.csv', '.txt')):
+        await reply(message, "Поддерживаются только файлы .csv и .txt со строками \"код,сайт\".")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await reply(message, "Файл слишком большой: Telegram позволяет боту скачивать файлы до 20 МБ.")
+        return
+
+    progress = await reply(message, f"⏳ Загружаю коды из {document.file_name}...", webhook_reply=False)
+    try:
+        # Файл скачивается на диск частями, а не в память
+        with tempfile.TemporaryFile() as file:
+            await document.download(destination_file=file)
+            counts = await import_codes(file)
+    except Exception as e:
+        logger.exception("Ошибка при загрузке кодов из файла %s", document.file_name)
+        await edit_text(progress, f"Ошибка при загрузке кодов: {e}")
+        return
+
+    await edit_text(
+        progress,
+        f"✅ Загрузка {document.file_name} завершена.\n\n"
+        f"Строк с кодами: {counts['lines']}\n"
+        f"Добавлено: {counts['inserted']}\n"
+        f"Дубликаты: {counts['duplicates']}\n"
+        f"Некорректные строки: {counts['malformed']}"
+    )
+
+def get_code_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("Получить код 🎟️", callback_data="get_code"))
+    return keyboard
 
 # Обработчик команды /start
 @dp.message_handler(commands=["start"])
+@rate_limit('start', THROTTLE_START_RATE, THROTTLE_START_BURST, THROTTLE_START_GLOBAL_RATE, THROTTLE_START_GLOBAL_BURST)
 async def start_command(message: types.Message):
-    logger.debug(f"Received /start command from user {message.from_user.id}")
+    update_log.debug("Received /start command from user %s", message.from_user.id)
     
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Получить код 🎟️", callback_data="get_code"))
-    await message.reply(
+    submit_reply(
+        message,
         f"👋 Привет, {message.from_user.first_name}! Я — бот для получения уникальных кодов 🧑‍💻.\n\n"
         "📝 Просто нажми на кнопку, чтобы получить свой код! 🎉",
-        reply_markup=keyboard
+        reply_markup=get_code_keyboard()
     )
 
+# Время от получения нажатия вебхуком до ответа на callback
+callback_ack_latency = LatencyStats()
+
+# Ответ на нажатие ставится в очередь первым и не ждет проверок, чтобы у пользователя
+# сразу пропал индикатор загрузки на кнопке. Нажатия get_code подтверждаются еще в
+# вебхуке (received_at — время получения), остальные — при обработке
+def acknowledge_callback(callback_query: types.CallbackQuery, received_at: float = None):
+    if received_at is None:
+        received_at = update_received_at.get()
+
+    def record(future: asyncio.Future):
+        if future.cancelled() or future.exception() is not None:
+            log_send_error(future)
+            return
+        if received_at is not None:
+            callback_ack_latency.observe(time.monotonic() - received_at)
+
+    future = outbox.submit('answer_callback_query', PRIORITY_ACK, callback_query_id=callback_query.id)
+    future.add_done_callback(record)
+
 # Обработчик callback на кнопку получения кода
+# Выдача кода выполняется для пользователя не более одного раза одновременно:
+# повторные нажатия во время выдачи присоединяются к уже идущей
+code_requests = SingleFlight()
+
 @dp.callback_query_handler(text="get_code")
+@rate_limit(
+    'get_code', THROTTLE_GET_CODE_RATE, THROTTLE_GET_CODE_BURST,
+    THROTTLE_GET_CODE_GLOBAL_RATE, THROTTLE_GET_CODE_GLOBAL_BURST,
+)
 async def send_code(callback_query: types.CallbackQuery):
+    if not callback_acknowledged.get():
+        acknowledge_callback(callback_query)
+    user_id = callback_query.from_user.id
+    await code_requests.run(user_id, lambda: process_code_request(callback_query))
+
+# Ход проверки и результат показываются изменением сообщения с кнопкой. Там, где
+# можно попробовать снова, кнопка возвращается.
+async def process_code_request(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    ip_address = str(callback_query.message.chat.id)  # Преобразуем chat.id в строку
+    message = callback_query.message
+    ip_address = str(message.chat.id)  # Преобразуем chat.id в строку
     
-    logger.debug(f"User {user_id} clicked on 'get_code'. IP: {ip_address}")
+    update_log.debug("User %s clicked on 'get_code'. IP: %s", user_id, ip_address)
     
+    # Повторные нажатия получают ответ из фильтра выданных кодов, без запросов к базе и API
+    ip_used = already_received = None
+    if issued_filter is not None:
+        ip_used, already_received = issued_filter.lookup(user_id, ip_address)
+        if issued_filter.definitive and (ip_used or already_received):
+            code_rejections.inc('ip_used' if ip_used else 'already_received')
+            submit_edit(
+                message,
+                "Вы не можете получить код повторно!" if ip_used else "Вы уже получили свой код!"
+            )
+            return
+
+    # Кнопка убирается на время проверки. Изменение информационное и не обгоняет сообщения
+    # с выданными кодами; позже результата оно не придет — finish() его отзывает
+    progress = outbox.submit(
+        'edit_message_text', PRIORITY_INFO,
+        chat_id=message.chat.id, message_id=message.message_id, text="⏳ Проверяем подписку и наличие кодов...",
+    )
+    progress.add_done_callback(log_send_error)
+
+    # Результат заменяет сообщение о проверке. Изменение «проверяем...», которое еще ждет
+    # в очереди (например, повтор после RetryAfter), отменяется, а уже отправляемое
+    # дожидается ответа — иначе оно могло бы прийти позже результата и скрыть код.
+    # Доставку результата воркер обновлений не ждет
+    async def finish(text: str, **kwargs):
+        await outbox.withdraw(progress)
+        submit_edit(message, text, **kwargs)
+
     # Проверка подписки на канал
     try:
         is_subscribed = await check_subscription(user_id)
         if not is_subscribed:
-            await callback_query.message.reply(
+            code_rejections.inc('not_subscribed')
+            await finish(
                 f"Для получения кода необходимо подписаться на канал! 🎉\n\n"
-                f"Подпишитесь на канал: {CHANNEL_LINK}"
-            )
-            return
-    except Exception as e:
-        logger.error(f"Ошибка при проверке подписки для пользователя {user_id}: {e}")
-        await callback_query.message.reply("Произошла ошибка при проверке вашей подписки. Попробуйте позже.")
-        return
-
-    # Проверка, был ли использован этот IP-адрес
-    try:
-        ip_used = await check_ip(ip_address)
-        if ip_used:
-            await callback_query.message.reply(
-                "Вы не можете получить код повторно!"
+                f"Подпишитесь на канал: {CHANNEL_LINK}",
+                reply_markup=get_code_keyboard()
             )
             return
     except Exception as e:
-        logger.error(f"Ошибка при проверке IP для пользователя {user_id}: {e}")
-        await callback_query.message.reply("Произошла ошибка попробуйте позже.")
+        logger.error("Ошибка при проверке подписки для пользователя %s: %s", user_id, e)
+        errors.inc('subscription')
+        await finish(
+            "Произошла ошибка при проверке вашей подписки. Попробуйте позже.",
+            reply_markup=get_code_keyboard()
+        )
         return
 
-    # Проверка, получил ли пользователь уже код
-    try:
-        already_received = await check_code_given(user_id)
-        if already_received:
-            await callback_query.message.reply(
-                "Вы уже получили свой код!"
+    # Проверка, был ли использован этот IP-адрес и получил ли пользователь уже код.
+    # Если фильтр точно знает, что кода не было, проверку выполняет сама выдача кода.
+    if issued_filter is None or ip_used or already_received:
+        try:
+            ip_used, already_received = await check_eligibility(user_id, ip_address)
+            if ip_used:
+                code_rejections.inc('ip_used')
+                if issued_filter is not None:
+                    issued_filter.add_chat(ip_address)
+                await finish(
+                    "Вы не можете получить код повторно!"
+                )
+                return
+            if already_received:
+                code_rejections.inc('already_received')
+                if issued_filter is not None:
+                    issued_filter.add_user(user_id)
+                await finish(
+                    "Вы уже получили свой код!"
+                )
+                return
+        except Exception as e:
+            logger.error("Ошибка при проверке выдачи кода для пользователя %s: %s", user_id, e)
+            errors.inc('eligibility')
+            await finish(
+                "Произошла ошибка при проверке, был ли вам выдан код. Попробуйте позже.",
+                reply_markup=get_code_keyboard()
             )
             return
-    except Exception as e:
-        logger.error(f"Ошибка при проверке кода для пользователя {user_id}: {e}")
-        await callback_query.message.reply("Произошла ошибка при проверке, был ли вам выдан код. Попробуйте позже.")
-        return
 
-    # Выдача уникального кода и сайта
+    # Выдача уникального кода и сайта (код сразу записывается за пользователем)
     try:
-        result = await get_unique_code()
-        if result:
+        status, result = await issue_code(user_id, ip_address)
+        if status == CLAIM_CLAIMED:
+            codes_issued.inc()
             code = result['code']
             site_url = result['site_url']
+            if issued_filter is not None:
+                issued_filter.add_user(user_id)
+                issued_filter.add_chat(ip_address)
             
-            await callback_query.message.reply(
+            await finish(
                 f"Ваш уникальный код: {code} 🎟️\n\n"
                 f"Сайт для использования кода: {site_url}\n\n"
-                "Этот код больше не доступен для получения повторно."
+                "Этот код больше не доступен для получения повторно.",
+                priority=PRIORITY_CODE,
+            )
+        elif status == CLAIM_ALREADY_CLAIMED:
+            code_rejections.inc('already_received')
+            await finish(
+                "Вы уже получили свой код!"
             )
-            
-            # Сохраняем данные в базе о том, что пользователь получил код и его IP
-            conn = await get_db_connection()
-            await conn.execute("INSERT INTO used_codes (user_id, code, ip_address) VALUES ($1, $2, $3)", user_id, code, ip_address)
-            await conn.close()
         else:
-            await callback_query.message.reply(
-                "Извините, все коды были выданы. Пожалуйста, попробуйте позже."
+            codes_sold_out.inc()
+            await finish(
+                "Извините, все коды были выданы. Пожалуйста, попробуйте позже.",
+                reply_markup=get_code_keyboard()
             )
     except Exception as e:
-        logger.error(f"Ошибка при выдаче кода для пользователя {user_id}: {e}")
-        await callback_query.message.reply("Произошла ошибка при выдаче кода. Попробуйте позже.")
+        logger.error("Ошибка при выдаче кода для пользователя %s: %s", user_id, e)
+        errors.inc('issue')
+        await finish(
+            "Произошла ошибка при выдаче кода. Попробуйте позже.",
+            reply_markup=get_code_keyboard()
+        )
+
+# Вступление в канал и выход из него (бот должен быть администратором канала)
+@dp.chat_member_handler()
+async def channel_member_updated(update: types.ChatMemberUpdated):
+    if not is_channel(update.chat):
+        return
+    member = update.new_chat_member
+    update_log.debug("User %s status in channel changed to %s", member.user.id, member.status)
+    await channel_members.update(member.user.id, member.status, update.date.astimezone(timezone.utc))
 
 # Вебхук для приема обновлений
 WEBHOOK_PATH = '/webhook'
 
-app = FastAPI()
+# Проверка запроса до чтения тела: секрет из заголовка сравнивается за постоянное время,
+# адрес источника — по заранее разобранному списку сетей. Отклоненные запросы
+# получают одинаковый ответ независимо от причины.
+class WebhookGuard:
+    def __init__(self, secret: str, allowed_networks: str):
+        self.secret = secret.encode()
+        self.networks = [
+            ipaddress.ip_network(network.strip(), strict=False)
+            for network in allowed_networks.split(',') if network.strip()
+        ]
+        self.rejected_secret = 0
+        self.rejected_network = 0
+
+    def _allowed_source(self, host):
+        if not self.networks:
+            return True
+        try:
+            address = ipaddress.ip_address(host)
+        except (TypeError, ValueError):
+            return False
+        return any(address in network for network in self.networks)
+
+    def check(self, request: Request):
+        token = request.headers.get('x-telegram-bot-api-secret-token', '').encode()
+        if not hmac.compare_digest(token, self.secret):
+            self.rejected_secret += 1
+            return False
+        if not self._allowed_source(request.client.host if request.client else None):
+            self.rejected_network += 1
+            return False
+        return True
+
+    def stats(self):
+        return {
+            "rejected_secret": self.rejected_secret,
+            "rejected_network": self.rejected_network,
+            "networks": len(self.networks),
+        }
+
+webhook_guard = WebhookGuard(WEBHOOK_SECRET, WEBHOOK_ALLOWED_NETWORKS)
+
+# Ограниченная очередь обновлений: вебхук только кладет обновление в очередь и сразу
+# отвечает Telegram, а обработку выполняют WEBHOOK_WORKERS фоновых задач
+class UpdateQueue:
+    def __init__(self, maxsize: int, workers: int):
+        self.queue = asyncio.Queue(maxsize)
+        self.workers = workers
+        self._tasks = []
+        self.busy = 0  # Воркеров, обрабатывающих обновление
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    # response — future для ответа вебхука, если включен WEBHOOK_REPLY_IN_RESPONSE;
+    # trace — трасса, начатая в вебхуке; acknowledged — нажатие уже подтверждено в вебхуке
+    def put(self, update: types.Update, response: asyncio.Future = None, trace: UpdateTrace = None,
+            acknowledged: bool = False):
+        try:
+            self.queue.put_nowait((update, time.monotonic(), response, trace, acknowledged))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    def full(self):
+        return self.queue.full()
+
+    # Новое обновление сразу возьмет свободный воркер (очередь короче числа свободных)
+    def has_idle_worker(self):
+        return self.queue.qsize() < self.workers - self.busy
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не обработано обновлений при остановке: %s", self.queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        while True:
+            update, enqueued_at, response, trace, acknowledged = await self.queue.get()
+            self.busy += 1
+            wait = time.monotonic() - enqueued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if trace is not None:
+                trace.add('queue', time.perf_counter() - wait, wait)
+            token = webhook_response.set(response)
+            received_token = update_received_at.set(enqueued_at)
+            trace_token = current_trace.set(trace)
+            acknowledged_token = callback_acknowledged.set(acknowledged)
+            try:
+                update_log.debug("Обработка обновления %s, ожидание в очереди %.1f мс", update.update_id, wait * 1000)
+                if await update_deduplicator.claim(update.update_id):
+                    await dp.process_update(update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                errors.inc('update')
+                logger.exception("Ошибка при обработке обновления %s", update.update_id)
+            finally:
+                webhook_response.reset(token)
+                update_received_at.reset(received_token)
+                current_trace.reset(trace_token)
+                callback_acknowledged.reset(acknowledged_token)
+                if trace is not None:
+                    tracer.finish(trace)
+                if response is not None and not response.done():
+                    response.set_result(None)  # Обработка завершилась без запросов к API
+                self.busy -= 1
+                self.queue.task_done()
+
+    def stats(self):
+        handled = self.processed + self.failed
+        return {
+            "depth": self.queue.qsize(),
+            "maxsize": self.queue.maxsize,
+            "workers": self.workers,
+            "busy": self.busy,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "wait_avg_ms": round(self.wait_total / handled * 1000, 3) if handled else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+# Разбор тела вебхука. Байты запроса разбираются один раз (orjson, если установлен),
+# и объект aiogram строится сразу из результата. Обновления типов, для которых нет
+# обработчиков (не из ALLOWED_UPDATES), отбрасываются до создания объектов.
+class UpdateDecoder:
+    def __init__(self, allowed_updates):
+        self.allowed_updates = tuple(allowed_updates)
+        self.decoded = 0
+        self.skipped = 0
+
+    # Возвращает None для обновлений, которые некому обрабатывать
+    def decode(self, body: bytes):
+        data = json_loads(body)
+        for kind in self.allowed_updates:
+            if kind in data:
+                self.decoded += 1
+                return types.Update(**data)
+        self.skipped += 1
+        return None
+
+    def stats(self):
+        return {"decoded": self.decoded, "skipped": self.skipped}
+
+update_decoder = UpdateDecoder(ALLOWED_UPDATES)
+
+# Telegram повторяет доставку, если вебхук ответил медленно или с ошибкой. Последние
+# UPDATE_DEDUP_WINDOW update_id хранятся в памяти (кольцо + множество, проверка за O(1)).
+# С UPDATE_DEDUP_DB обновление перед обработкой еще и регистрируется в processed_updates,
+# чтобы повтор, попавший на другую реплику, тоже был отброшен.
+statements.register(
+    'mark_update_processed',
+    "INSERT INTO processed_updates (update_id) VALUES ($1) ON CONFLICT DO NOTHING RETURNING 1",
+    hot=UPDATE_DEDUP_DB,
+)
+statements.register(
+    'cleanup_processed_updates',
+    "DELETE FROM processed_updates WHERE received_at < now() - make_interval(secs => $1)",
+    hot=False,
+)
+
+class UpdateDeduplicator:
+    CLEANUP_EVERY = 1000
+
+    def __init__(self, window: int, use_db: bool, db_ttl: int):
+        self.use_db = use_db
+        self.db_ttl = db_ttl
+        self._order = deque()
+        self._seen = set()
+        self._window = window
+        self._db_marks = 0
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id: int):
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def remember(self, update_id: int):
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self._window:
+            self._seen.discard(self._order.popleft())
+
+    # Возвращает False, если обновление уже обработала другая реплика
+    async def claim(self, update_id: int):
+        if not self.use_db:
+            return True
+        async with get_db_connection() as conn:
+            inserted = await statements.fetchval(conn, 'mark_update_processed', update_id)
+        self._db_marks += 1
+        if self._db_marks % self.CLEANUP_EVERY == 0:
+            run_in_background(self._cleanup())
+        if inserted is None:
+            self.duplicates += 1
+            return False
+        return True
+
+    async def _cleanup(self):
+        async with get_db_connection() as conn:
+            await statements.execute(conn, 'cleanup_processed_updates', self.db_ttl)
+
+    def stats(self):
+        return {"window": len(self._order), "duplicates": self.duplicates, "db": self.use_db}
+
+update_deduplicator = UpdateDeduplicator(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_DB, UPDATE_DEDUP_DB_TTL)
+
+update_queue = UpdateQueue(WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS)
+
+# Размеры пула и очередей и счетчики, которые уже ведут объекты выше
+metrics.register(Collected(
+    'bot_db_pool_connections', 'gauge', 'Database pool connections',
+    lambda: {key: value for key, value in get_pool_stats().items() if key in ('idle', 'in_use')}, 'state',
+))
+metrics.register(Collected('bot_update_queue_depth', 'gauge', 'Updates waiting for a worker', lambda: update_queue.queue.qsize()))
+metrics.register(Collected('bot_outbox_depth', 'gauge', 'Bot API requests waiting to be sent', lambda: outbox.queue.qsize()))
+metrics.register(Collected('bot_updates_dropped_total', 'counter', 'Updates rejected with a full queue', lambda: update_queue.dropped))
+metrics.register(Collected('bot_updates_duplicate_total', 'counter', 'Redelivered updates dropped', lambda: update_deduplicator.duplicates))
+metrics.register(Collected(
+    'bot_webhook_rejected_total', 'counter', 'Webhook requests rejected before parsing',
+    lambda: {'secret': webhook_guard.rejected_secret, 'network': webhook_guard.rejected_network}, 'reason',
+))
+metrics.register(Collected('bot_throttled_total', 'counter', 'Updates dropped by throttling', lambda: throttling.throttled))
+
+# Длительность этапов запуска в миллисекундах
+startup_timings = {}
+
+@asynccontextmanager
+async def startup_phase(name: str):
+    started = time.perf_counter()
+    yield
+    startup_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info("Запуск: %s — %.1f мс", name, startup_timings[name])
+
+async def close_bot_session():
+    session = await bot.get_session()
+    await session.close()
+
+# Весь запуск выполняется в цикле событий сервера, поэтому пул, HTTP-сессия бота
+# и фоновые задачи, созданные здесь, используются обработчиками без повторной инициализации
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with startup_phase("schema"):
+        await create_tables()
+    # Соединения пула создаются с уже подготовленными горячими запросами
+    async with startup_phase("db_pool"):
+        await create_db_pool()
+    async with startup_phase("caches"):
+        if issued_filter is not None:
+            await issued_filter.warm()
+        await channel_members.start()
+    if code_reservoir is not None:
+        async with startup_phase("code_reservoir"):
+            await code_reservoir.start()
+    # Первый запрос к API открывает HTTP-сессию бота, дальше она переиспользуется
+    async with startup_phase("bot_session"):
+        await bot.me
+    async with startup_phase("webhook"):
+        await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, allowed_updates=ALLOWED_UPDATES, secret_token=WEBHOOK_SECRET)
+    async with startup_phase("workers"):
+        await tracer.start()
+        await outbox.start()
+        await update_queue.start()
+    try:
+        yield
+    finally:
+        await update_queue.stop(WEBHOOK_DRAIN_TIMEOUT)
+        await outbox.stop(WEBHOOK_DRAIN_TIMEOUT)
+        await tracer.stop()
+        await channel_members.stop()
+        if code_reservoir is not None:
+            await code_reservoir.stop()
+        await close_bot_session()
+        await close_db_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.post(WEBHOOK_PATH)
 async def webhook(request: Request):
+    if not webhook_guard.check(request):
+        return JSONResponse({"status": "forbidden"}, status_code=403)
+    trace = UpdateTrace()
+    received_at = time.monotonic()
     try:
-        json_str = await request.json()
-        update = types.Update(**json_str)
-        await dp.process_update(update)
+        body = await request.body()
+        parse_started = time.perf_counter()
+        update = update_decoder.decode(body)
+        trace.add('parse', parse_started, time.perf_counter() - parse_started)
+        if update is None:
+            return {"status": "skipped"}
+        trace.update_id = update.update_id
+        if update_deduplicator.is_duplicate(update.update_id):
+            return {"status": "duplicate"}
+        # Нажатие get_code проверяется ограничением частоты и подтверждается здесь, а не в
+        # воркере: индикатор на кнопке пропадает сразу, даже если очередь обновлений длинная.
+        # Ограниченные нажатия в очередь не попадают. При заполненной очереди лимит не
+        # расходуется: обновление получит 503 и придет снова
+        callback_query = update.callback_query
+        acknowledged = callback_query is not None and callback_query.data == 'get_code'
+        if acknowledged and not update_queue.full() and not throttling.allow_callback(callback_query, send_code):
+            update_deduplicator.remember(update.update_id)
+            return {"status": "throttled"}
+        # Ответ в вебхуке ждем, только если обновление сразу возьмет свободный воркер: при
+        # очереди ожидание держало бы соединение Telegram и ограничивало прием обновлений
+        response = None
+        if WEBHOOK_REPLY_IN_RESPONSE and update_queue.has_idle_worker():
+            response = asyncio.get_running_loop().create_future()
+        if not update_queue.put(update, response, trace, acknowledged):
+            # Очередь заполнена: Telegram повторит доставку позже
+            return JSONResponse({"status": "busy"}, status_code=503)
+        update_deduplicator.remember(update.update_id)
+        if acknowledged:
+            acknowledge_callback(callback_query, received_at)
+        if response is not None:
+            try:
+                payload = await asyncio.wait_for(asyncio.shield(response), timeout=WEBHOOK_REPLY_WAIT)
+            except asyncio.TimeoutError:
+                # Не дождались: дальнейшие запросы обработчика пойдут обычным путем
+                if not response.done():
+                    response.set_result(None)
+                payload = None
+            if payload is not None:
+                return payload
         return {"status": "success"}
     except Exception as e:
         logger.exception("Ошибка в вебхуке")  # Подробное логирование
+        errors.inc('webhook')
         return {"status": "error", "message": str(e)}
 
+# Метрики в формате Prometheus
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Статистика для мониторинга
+@app.get("/stats")
+async def stats():
+    result = {
+        "db_pool": get_pool_stats(),
+        "update_queue": update_queue.stats(),
+        "update_decoder": update_decoder.stats(),
+        "webhook_guard": webhook_guard.stats(),
+        "update_dedup": update_deduplicator.stats(),
+        "code_requests": code_requests.stats(),
+        "throttling": throttling.stats(),
+        "outbox": outbox.stats(),
+        "callback_ack": callback_ack_latency.stats(),
+        "statements": statements.stats(),
+        "tracing": tracer.stats(),
+        "startup_ms": startup_timings,
+    }
+    if code_reservoir is not None:
+        result["code_reservoir"] = code_reservoir.stats()
+    if issued_filter is not None:
+        result["issued_filter"] = issued_filter.stats()
+    result["subscription_cache"] = subscription_cache.stats()
+    result["channel_members"] = channel_members.stats()
+    return result
+
 if __name__ == "__main__":
-    # Создаем таблицы при старте
-    asyncio.run(create_tables())
-    
-    # Устанавливаем вебхук
-    asyncio.run(bot.set_webhook(WEBHOOK_URL + "/webhook"))
-    
-    # Запуск FastAPI приложения
+    # Запуск FastAPI приложения (таблицы, пул и вебхук настраиваются в lifespan)
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=10000)